@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+# A stand-in for itex2MML, to test the itex support of textile.py without
+# it. Like itex2MML, it reads text from the standard input and writes it
+# to the standard output with the equations ($inline$ and \[display\])
+# converted to <math> elements; here they only get the equation as text.
+#
+# If the ITEX_STUB_LOG environment variable is set, a line is appended to
+# that file on each run, so the runs can be counted.
+
+import sys
+import os
+import re
+
+def convert(m):
+    if m.group(1) is not None:
+        return '<math mode="display">%s</math>' % m.group(1)
+    return '<math>%s</math>' % m.group(2)
+
+def main():
+    log = os.environ.get("ITEX_STUB_LOG")
+    if log:
+        fo = open(log, "a")
+        fo.write("run\n")
+        fo.close()
+    text = sys.stdin.read()
+    sys.stdout.write(re.sub(r"\\\[([\s\S]*?)\\\]|\$(.*?)\$", convert, text))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -147,6 +147,47 @@ SANITIZE = 0
 # Turn debug on?
 DEBUGLEVEL = 0
 
+# Collect statistics for profiling? This times each pattern used by
+# preg_replace() (see pattern_stats()), which costs about as much as
+# a short substitution, and counts the runs of the inline stages and
+# the kinds of paragraphs (see stage_stats() and paragraph_stats()),
+# so it's off by default. The calls of each pattern are always
+# counted.
+STATS = 0
+
+# Rendered blocks can be kept in a cache (see BlockCache), so
+# only the blocks that changed are rendered again. This is the
+# maximum number of blocks kept in a cache.
+CACHE_SIZE = 10000
+
+# Colorized Python code (see Textiler.bc) can be kept in a cache
+# too, by language and the hash of the code, so it isn't colorized
+# again. This is the path of the cache, a file or a directory (where
+# it's kept as textile-colors.db, apart from the blocks), or None for
+# no cache.
+COLOR_CACHE = None
+
+# When streaming (see textile_iter), blocks with references to
+# footnotes not defined yet are held back until the footnote
+# is found, to add its title to the reference. This is the
+# maximum size in bytes of the HTML held back; past that the
+# blocks are written without the missing titles.
+FOOTNOTE_WINDOW = 65536
+
+# Optional features of Textile, which cost some time even when
+# they're not used:
+#
+#   itex       inline $itex$ and \[itex\] blocks
+#   searches   smart searches in links, like "textile":google
+#   caps       <span class="caps"> around upper-case words
+#   macros     character macros, like {e'}
+#   footnotes  titles in the references to footnotes
+#
+# This is a profile, either 'full' (all of them) or 'minimal' (none),
+# or a list of the features to use. It can also be given to textile()
+# as the features argument.
+FEATURES = 'full'
+
 # Amazon associate for links: "keywords":amazon
 # If you don't have one, please consider leaving mine here as
 # a small compensation for writing PyTextile. It's commented
@@ -160,8 +201,16 @@ AMAZON = 'www.amazon.com'
 import re
 import sys
 import os
+import time
+import subprocess
 import sgmllib
 import unicodedata
+import hashlib
+import itertools
+import marshal
+import threading
+import json
+from collections import OrderedDict
 
 
 def _in_tag(text, tag):
@@ -254,12 +303,27 @@ except ImportError:
         _tidy = None
     
 
+# The block cache is stored in a SQLite database.
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+# Blocks can be rendered in parallel by a pool of processes.
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+
 # This is good for debugging.
 def _debug(s, level=1):
     """Outputs debug information to sys.stderr.
 
     This function outputs debug information if DEBUGLEVEL is
-    higher than a given treshold.
+    higher than a given treshold. Callers in hot paths check
+    DEBUGLEVEL first, so they don't build <s> for nothing.
     """
     if DEBUGLEVEL >= level: print >> sys.stderr, s
 
@@ -269,11 +333,14 @@ def _debug(s, level=1):
 parameters = {
     # Horizontal alignment.
     'align':    r'''(?:(?:<>|[<>=])                 # Either '<>', '<', '>' or '='
-                    (?![^\s]*(?:<>|[<>=])))         # Look-ahead to ensure it happens once
+                    (?![^\s<>=]*[<>=]))             # Look-ahead to ensure it happens once
                  ''',
 
-    # Horizontal padding.
-    'padding':  r'''(?:[\(\)]+)                     # Any number of '(' and/or ')'
+    # Horizontal padding. The attributes are repeated, so a single
+    # '(' or ')' here takes any number of them: a '+' here too would
+    # make a failed match try every way to split a run of them, which
+    # takes exponential time.
+    'padding':  r'''[\(\)]                          # '(' or ')'
                  ''',
 
     # Class and/or id.
@@ -288,12 +355,12 @@ parameters = {
            
     # Language.
     'lang':     r'''(?:\[[\w-]+\])                  # [lang]
-                    (?![^\s]*(?:\[.*?\]))           # must happen once
+                    (?![^\s\[]*\[.*?\])             # must happen once
                  ''',
 
     # Style.
     'style':    r'''(?:{[^\}]+})                    # {style}
-                    (?![^\s]*(?:{.*?}))             # must happen once
+                    (?![^\s{]*{.*?})                # must happen once
                  ''',
 }
 
@@ -385,11 +452,13 @@ res = {
                   )?                                        #
               ''' % parameters,
 
-    # Qtag attributes.
+    # Qtag attributes. The style can't have a '{', or each delimiter
+    # in a run like '%{%{%{' would look for a '}' up to the end of
+    # the text.
     'qattr': r'''(?P<parameters>                            #
                      (?: %(classid)s                        # class and/or id
                      |   %(lang)s                           # [lang]
-                     |   %(style)s                          # {style}
+                     |   {[^{}]+}(?![^\s{]*{.*?})           # {style}, must happen once
                      )+                                     #
                  )?                                         #
               ''' % parameters,
@@ -408,10 +477,10 @@ res = {
     'iattr': r'''(?P<parameters>                            #
                      (?:                                    #
                      (?: [<>]+                              # horizontal alignment tags
-                         (?![^\s]*(?:[<>])))                #     (must happen once)
+                         (?![^\s<>]*[<>]))                  #     (must happen once)
                      |                                      # 
                      (?: [\-\^~]+                           # vertical alignment tags
-                         (?![^\s]*(?:[\-\^~])))             #     (must happen once)
+                         (?![^\s\-\^~]*[\-\^~]))            #     (must happen once)
                      | %(classid)s                          # class and/or id
                      | %(padding)s                          # padding tags
                      | %(style)s                            # {style}
@@ -449,6 +518,1153 @@ res = {
               ''' % parameters,
 }
 
+# These are the blocks we know. Each signature is a (regexp, handler, leaders)
+# tuple, where <leaders> lists the characters a block must start with for the
+# signature to have a chance to match.
+signatures = [
+                   # Paragraph.
+                   (r'''^p                       # Paragraph signature
+                        %(battr)s                # Paragraph attributes
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended paragraph denoted by a second dot
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'paragraph', 'p'),
+   
+                   # Pre-formatted text.
+                   (r'''^pre                     # Pre signature
+                        %(battr)s                # Pre attributes
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended pre denoted by a second dot
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'pre', 'p'),
+   
+                   # Block code.
+                   (r'''^bc                      # Blockcode signature
+                        %(battr)s                # Blockcode attributes
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended blockcode denoted by a second dot
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'bc', 'b'),
+   
+                   # Blockquote.
+                   (r'''^bq                      # Blockquote signature
+                        %(battr)s                # Blockquote attributes
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended blockquote denoted by a second dot
+                        (:(?P<cite>              # Optional cite attribute
+                        (                        #
+                            %(url)s              #     URL
+                        |   "[\w]+(?:\s[\w]+)*"  #     "Name inside quotes"
+                        ))                       #
+                        )?                       #
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'blockquote', 'b'),
+   
+                   # Header.
+                   (r'''^h                       # Header signature
+                        (?P<header>\d)           # Header number
+                        %(battr)s                # Header attributes
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended header denoted by a second dot
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'header', 'h'),
+   
+                   # Footnote.
+                   (r'''^fn                      # Footnote signature
+                        (?P<footnote>[\d]+)      # Footnote number
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended footnote denoted by a second dot
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''', 'footnote', 'f'),
+   
+                   # Definition list.
+                   (r'''^dl                      # Definition list signature
+                        %(battr)s                # Definition list attributes
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended definition list denoted by a second dot
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'dl', 'd'),
+                   
+                   # Ordered list (attributes to first <li>).
+                   (r'''^%(olattr)s              # Ordered list attributes
+                        \#                       # Ordered list signature
+                        %(liattr)s               # List item attributes
+                        (?P<dot>\.)?             # .
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'ol', '#<>=()[{'),
+   
+                   # Unordered list (attributes to first <li>).
+                   (r'''^%(olattr)s              # Unrdered list attributes
+                        \*                       # Unordered list signature
+                        %(liattr)s               # Unordered list attributes
+                        (?P<dot>\.)?             # .
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'ul', '*<>=()[{'),
+   
+                   # Escaped text.
+                   (r'''^==?(?P<text>.*?)(==)?$  # Escaped text
+                     ''', 'escape', '='),
+   
+                   (r'''^(?P<text><.*)$          # XHTML tag
+                     ''', 'escape', '<'),
+   
+                   # itex code.
+                   (r'''^(?P<text>               # itex code
+                        \\\[                     # starts with \[
+                        .*?                      # complicated mathematical equations go here
+                        \\\])                    # ends with \]
+                     ''', 'itex', '\\'),
+   
+                   # Tables.
+                   (r'''^table                   # Table signature
+                        %(tattr)s                # Table attributes
+                        (?P<dot>\.)              # .
+                        (?P<extend>\.)?          # Extended blockcode denoted by a second dot
+                        \s                       # whitespace
+                        (?P<text>.*)             # text
+                     ''' % res, 'table', 't'),
+                   
+                   # Simple tables.
+                   (r'''^(?P<text>
+                        \|
+                        .*)
+                     ''', 'table', '|'),
+   
+                   # About.
+                   (r'''^(?P<text>tell\sme\sabout\stextile\.)$''', 'about', 't'),
+                  ]
+
+
+def _build_dispatcher(signatures):
+    """Index the block signatures by their leading characters.
+
+    Each signature is compiled only once. The result maps a character
+    to the (compiled regexp, handler name) pairs that can match a block
+    starting with it, in the same order as in the signatures list.
+
+    The blocks are matched where they are in the text, with
+    match(text, start, end), and there '^' would only match at the
+    start of the text. So it's left out, as match() is anchored
+    anyway.
+    """
+    dispatcher = {}
+    for regexp, handler, leaders in signatures:
+        if regexp.startswith('^'):
+            regexp = regexp[1:]
+        p = re.compile(regexp, re.VERBOSE | re.DOTALL)
+        for c in leaders:
+            dispatcher.setdefault(c, []).append((p, handler))
+
+    return dispatcher
+
+_dispatcher = _build_dispatcher(signatures)
+
+# Without the itex feature, \[itex\] blocks are paragraphs.
+_dispatcher_no_itex = dict([(c, [(p, handler) for (p, handler) in handlers if handler != 'itex'])
+                            for (c, handlers) in _dispatcher.items()])
+
+# The features and profiles, see FEATURES.
+_all_features = frozenset(['itex', 'searches', 'caps', 'macros', 'footnotes'])
+_profiles = {'full': _all_features, 'minimal': frozenset()}
+
+# Macros, see Textiler.macros(). Don't change them, they're shared.
+_macros = {'c|': '&#162;',       # cent sign
+           '|c': '&#162;',       # cent sign
+           'L-': '&#163;',       # pound sign
+           '-L': '&#163;',       # pound sign
+           'Y=': '&#165;',       # yen sign
+           '=Y': '&#165;',       # yen sign
+           '(c)': '&#169;',      # copyright sign
+           '<<': '&#171;',       # left-pointing double angle quotation
+           '(r)': '&#174;',      # registered sign
+           '+_': '&#177;',       # plus-minus sign
+           '_+': '&#177;',       # plus-minus sign
+           '>>': '&#187;',       # right-pointing double angle quotation
+           '1/4': '&#188;',      # vulgar fraction one quarter
+           '1/2': '&#189;',      # vulgar fraction one half
+           '3/4': '&#190;',      # vulgar fraction three quarters
+           'A`': '&#192;',       # latin capital letter a with grave
+           '`A': '&#192;',       # latin capital letter a with grave
+           'A\'': '&#193;',      # latin capital letter a with acute
+           '\'A': '&#193;',      # latin capital letter a with acute
+           'A^': '&#194;',       # latin capital letter a with circumflex
+           '^A': '&#194;',       # latin capital letter a with circumflex
+           'A~': '&#195;',       # latin capital letter a with tilde
+           '~A': '&#195;',       # latin capital letter a with tilde
+           'A"': '&#196;',       # latin capital letter a with diaeresis
+           '"A': '&#196;',       # latin capital letter a with diaeresis
+           'Ao': '&#197;',       # latin capital letter a with ring above
+           'oA': '&#197;',       # latin capital letter a with ring above
+           'AE': '&#198;',       # latin capital letter ae
+           'C,': '&#199;',       # latin capital letter c with cedilla
+           ',C': '&#199;',       # latin capital letter c with cedilla
+           'E`': '&#200;',       # latin capital letter e with grave
+           '`E': '&#200;',       # latin capital letter e with grave
+           'E\'': '&#201;',      # latin capital letter e with acute
+           '\'E': '&#201;',      # latin capital letter e with acute
+           'E^': '&#202;',       # latin capital letter e with circumflex
+           '^E': '&#202;',       # latin capital letter e with circumflex
+           'E"': '&#203;',       # latin capital letter e with diaeresis
+           '"E': '&#203;',       # latin capital letter e with diaeresis
+           'I`': '&#204;',       # latin capital letter i with grave
+           '`I': '&#204;',       # latin capital letter i with grave
+           'I\'': '&#205;',      # latin capital letter i with acute
+           '\'I': '&#205;',      # latin capital letter i with acute
+           'I^': '&#206;',       # latin capital letter i with circumflex
+           '^I': '&#206;',       # latin capital letter i with circumflex
+           'I"': '&#207;',       # latin capital letter i with diaeresis
+           '"I': '&#207;',       # latin capital letter i with diaeresis
+           'D-': '&#208;',       # latin capital letter eth
+           '-D': '&#208;',       # latin capital letter eth
+           'N~': '&#209;',       # latin capital letter n with tilde
+           '~N': '&#209;',       # latin capital letter n with tilde
+           'O`': '&#210;',       # latin capital letter o with grave
+           '`O': '&#210;',       # latin capital letter o with grave
+           'O\'': '&#211;',      # latin capital letter o with acute
+           '\'O': '&#211;',      # latin capital letter o with acute
+           'O^': '&#212;',       # latin capital letter o with circumflex
+           '^O': '&#212;',       # latin capital letter o with circumflex
+           'O~': '&#213;',       # latin capital letter o with tilde
+           '~O': '&#213;',       # latin capital letter o with tilde
+           'O"': '&#214;',       # latin capital letter o with diaeresis
+           '"O': '&#214;',       # latin capital letter o with diaeresis
+           'O/': '&#216;',       # latin capital letter o with stroke
+           '/O': '&#216;',       # latin capital letter o with stroke
+           'U`':  '&#217;',      # latin capital letter u with grave
+           '`U':  '&#217;',      # latin capital letter u with grave
+           'U\'': '&#218;',      # latin capital letter u with acute
+           '\'U': '&#218;',      # latin capital letter u with acute
+           'U^': '&#219;',       # latin capital letter u with circumflex
+           '^U': '&#219;',       # latin capital letter u with circumflex
+           'U"': '&#220;',       # latin capital letter u with diaeresis
+           '"U': '&#220;',       # latin capital letter u with diaeresis
+           'Y\'': '&#221;',      # latin capital letter y with acute
+           '\'Y': '&#221;',      # latin capital letter y with acute
+           'a`': '&#224;',       # latin small letter a with grave
+           '`a': '&#224;',       # latin small letter a with grave
+           'a\'': '&#225;',      # latin small letter a with acute
+           '\'a': '&#225;',      # latin small letter a with acute
+           'a^': '&#226;',       # latin small letter a with circumflex
+           '^a': '&#226;',       # latin small letter a with circumflex
+           'a~': '&#227;',       # latin small letter a with tilde
+           '~a': '&#227;',       # latin small letter a with tilde
+           'a"': '&#228;',       # latin small letter a with diaeresis
+           '"a': '&#228;',       # latin small letter a with diaeresis
+           'ao': '&#229;',       # latin small letter a with ring above
+           'oa': '&#229;',       # latin small letter a with ring above
+           'ae': '&#230;',       # latin small letter ae
+           'c,': '&#231;',       # latin small letter c with cedilla
+           ',c': '&#231;',       # latin small letter c with cedilla
+           'e`': '&#232;',       # latin small letter e with grave
+           '`e': '&#232;',       # latin small letter e with grave
+           'e\'': '&#233;',      # latin small letter e with acute
+           '\'e': '&#233;',      # latin small letter e with acute
+           'e^': '&#234;',       # latin small letter e with circumflex
+           '^e': '&#234;',       # latin small letter e with circumflex
+           'e"': '&#235;',       # latin small letter e with diaeresis
+           '"e': '&#235;',       # latin small letter e with diaeresis
+           'i`': '&#236;',       # latin small letter i with grave
+           '`i': '&#236;',       # latin small letter i with grave
+           'i\'': '&#237;',      # latin small letter i with acute
+           '\'i': '&#237;',      # latin small letter i with acute
+           'i^': '&#238;',       # latin small letter i with circumflex
+           '^i': '&#238;',       # latin small letter i with circumflex
+           'i"': '&#239;',       # latin small letter i with diaeresis
+           '"i': '&#239;',       # latin small letter i with diaeresis
+           'n~': '&#241;',       # latin small letter n with tilde
+           '~n': '&#241;',       # latin small letter n with tilde
+           'o`': '&#242;',       # latin small letter o with grave
+           '`o': '&#242;',       # latin small letter o with grave
+           'o\'': '&#243;',      # latin small letter o with acute
+           '\'o': '&#243;',      # latin small letter o with acute
+           'o^': '&#244;',       # latin small letter o with circumflex
+           '^o': '&#244;',       # latin small letter o with circumflex
+           'o~': '&#245;',       # latin small letter o with tilde
+           '~o': '&#245;',       # latin small letter o with tilde
+           'o"': '&#246;',       # latin small letter o with diaeresis
+           '"o': '&#246;',       # latin small letter o with diaeresis
+           ':-': '&#247;',       # division sign
+           '-:': '&#247;',       # division sign
+           'o/': '&#248;',       # latin small letter o with stroke
+           '/o': '&#248;',       # latin small letter o with stroke
+           'u`': '&#249;',       # latin small letter u with grave
+           '`u': '&#249;',       # latin small letter u with grave
+           'u\'': '&#250;',      # latin small letter u with acute
+           '\'u': '&#250;',      # latin small letter u with acute
+           'u^': '&#251;',       # latin small letter u with circumflex
+           '^u': '&#251;',       # latin small letter u with circumflex
+           'u"': '&#252;',       # latin small letter u with diaeresis
+           '"u': '&#252;',       # latin small letter u with diaeresis
+           'y\'': '&#253;',      # latin small letter y with acute
+           '\'y': '&#253;',      # latin small letter y with acute
+           'y"': '&#255',        # latin small letter y with diaeresis
+           '"y': '&#255',        # latin small letter y with diaeresis
+           'OE': '&#338;',       # latin capital ligature oe
+           'oe': '&#339;',       # latin small ligature oe
+           '*': '&#8226;',       # bullet
+           'Fr': '&#8355;',      # french franc sign
+           'L=': '&#8356;',      # lira sign
+           '=L': '&#8356;',      # lira sign
+           'Rs': '&#8360;',      # rupee sign
+           'C=': '&#8364;',      # euro sign
+           '=C': '&#8364;',      # euro sign
+           'tm': '&#8482;',      # trade mark sign
+           '<-': '&#8592;',      # leftwards arrow
+           '->': '&#8594;',      # rightwards arrow
+           '<=': '&#8656;',      # leftwards double arrow
+           '=>': '&#8658;',      # rightwards double arrow
+           '=/': '&#8800;',      # not equal to
+           '/=': '&#8800;',      # not equal to
+           '<_': '&#8804;',      # less-than or equal to
+           '_<': '&#8804;',      # less-than or equal to
+           '>_': '&#8805;',      # greater-than or equal to
+           '_>': '&#8805;',      # greater-than or equal to
+           ':(': '&#9785;',      # white frowning face
+           ':)': '&#9786;',      # white smiling face
+           'spade': '&#9824;',   # black spade suit
+           'club': '&#9827;',    # black club suit
+           'heart': '&#9829;',   # black heart suit
+           'diamond': '&#9830;', # black diamond suit
+          }
+
+# Unicode character names already looked up by _unicode_entity(),
+# and how many of them are kept.
+_unicode_entities = {}
+_UNICODE_ENTITIES_SIZE = 1000
+
+
+def _unicode_entity(name):
+    """Character reference for a unicode character name.
+
+    Returns None if there's no character with that name. The names
+    found in a text are usually few, so the results are kept.
+    """
+    try:
+        return _unicode_entities[name]
+    except KeyError:
+        pass
+
+    try:
+        entity = unicodedata.lookup(name)
+        entity = entity.encode('ascii', 'xmlcharrefreplace')
+    except:
+        entity = None
+
+    if len(_unicode_entities) >= _UNICODE_ENTITIES_SIZE:
+        _unicode_entities.clear()
+    _unicode_entities[name] = entity
+
+    return entity
+
+# Blocks are separated by empty lines. We capture the \n's because
+# they are important inside "pre..".
+_block_separator = re.compile(r'''((\n\s*){2,})''')
+
+# Clear signature, matched in place like the block signatures (see
+# _build_dispatcher()).
+_clear_signature = re.compile(r'''clear(?P<alignment>[<>])?\.$''')
+
+# List item, list and table cell attributes.
+_li_attributes = re.compile(r'''^%(liattr)s\s''' % res, re.VERBOSE)
+_ol_attributes = re.compile(r'''^%(olattr)s''' % res, re.VERBOSE)
+_cell = re.compile(r'''(?:%(tattr)s\.\s)?(?P<text>.*)''' % res, re.VERBOSE)
+_table_rows = re.compile(r'''\n+''')
+_cell_period = re.compile(r'''\.\s''')
+
+# Block parameters.
+_param_class = re.compile(r'''\((?P<class>[\w]+(\s[\w]+)*)(\#[\w][\w\d\.:_-]*)?\)''')
+_param_id = re.compile(r'''\([\w]*(\s[\w]+)*\#(?P<id>[\w][\w\d\.:_-]*)\)''')
+_param_lang = re.compile(r'''\[(?P<lang>[\w-]+)\]''')
+_param_style = re.compile(r'''{(?P<style>[^\}]+)}''')
+_param_classid_remove = re.compile(r'''\([\#\w\d\.:_\s-]+\)''')
+_param_lang_remove = re.compile(r'''\[[\w-]+\]''')
+_param_style_remove = re.compile(r'''{[\w:;#%-]+}''')
+_param_colspan = re.compile(r'''\\(\d+)''')
+_param_rowspan = re.compile(r'''/(\d+)''')
+
+# How many parsed parameters and open tags a Textiler remembers.
+_MEMO_SIZE = 1000
+
+# Link lookups, like '[id]example.com'.
+_link_definition = re.compile(r'''(?:^|\n)\[([\w]+?)\](%(url)s)(?:$|\n)''' % res, re.VERBOSE)
+
+# How much to read at once when streaming.
+_READ_SIZE = 65536
+
+# How much text can be read without a place to cut it before it's cut
+# at a line break anyway, see _read_cut().
+_CUT_WINDOW = 4 * _READ_SIZE
+
+# How many '<' or quick tag delimiters a text can have and still be
+# matched with the plain regular expressions: each one can scan up to
+# the end of its line, so this bounds the time to a few passes.
+_SCAN_LIMIT = 16
+
+# What Textiler.sanitize() fixes: single tags that are not closed, and
+# ampersands that don't start an entity.
+_single_tag = re.compile(r'''<(img|br|hr)(.*?)(?:\s*/?\s*)?>''')
+_single_tag_start = re.compile(r'''<(?:img|br|hr)''')
+_non_space = re.compile(r'''\S''')
+_bare_ampersand = re.compile(r'''&(?!#?[xX]?(?:[0-9a-fA-F]+|\w{1,8});)''')
+
+
+def _read_pieces(source):
+    """Pieces of _READ_SIZE of a string, file object or mmap."""
+    if hasattr(source, 'read'):
+        while 1:
+            data = source.read(_READ_SIZE)
+            if not data:
+                break
+            yield data
+    else:
+        for i in xrange(0, len(source), _READ_SIZE):
+            yield source[i:i + _READ_SIZE]
+
+
+def _read_cut(source, find_cut, window=None):
+    """Read a text in pieces, cut where <find_cut> finds a place.
+
+    <source> is a string, file object or mmap, read in pieces of
+    _READ_SIZE with the carriage returns zapped. find_cut(buf, scan)
+    returns (cut, scan): the last place where <buf> can be cut,
+    looking from <scan> on, or None, and where to look from on the
+    next call, so each part of the text is only looked at once. If
+    no place comes up in <window> bytes, the text is cut at a line
+    break anyway.
+
+    Yields the pieces, without the whitespace at the start and the
+    end of the text.
+    """
+    buf = ''
+    cr = ''
+    scan = 0
+    held = None
+    for data in _read_pieces(source):
+        # Zap carriage returns, keeping a trailing '\r' for later in
+        # case a '\n' follows.
+        data = cr + data
+        cr = ''
+        if data.endswith('\r'):
+            data, cr = data[:-1], '\r'
+        if '\r' in data:
+            data = data.replace("\r\n", "\n").replace("\r", "\n")
+
+        # Remove leading whitespace.
+        if held is None:
+            data = data.lstrip()
+            if not data:
+                continue
+            held = []
+        buf += data
+
+        cut, scan = find_cut(buf, scan)
+        if cut is None and window is not None and len(buf) > window:
+            cut = buf.rfind('\n', len(buf) - len(data)) + 1 or None
+        if cut is None:
+            continue
+
+        piece = buf[:cut]
+        buf = buf[cut:]
+        scan = max(0, scan - cut)
+
+        # The last piece with text is held back, with any pieces of
+        # whitespace after it, as its whitespace may end the text.
+        if piece.isspace():
+            held.append(piece)
+        else:
+            for text in held:
+                yield text
+            held = [piece]
+
+    buf = buf.rstrip()
+    if buf:
+        for text in held:
+            yield text
+        yield buf
+    elif held:
+        yield held[0].rstrip()
+
+
+def _fix_cut(buf, scan):
+    """Where <buf> can be cut without splitting a fix of
+    Textiler.sanitize(), see _read_cut().
+
+    That's after a line break, as long as what comes next can't end
+    a single tag (it doesn't start with '/' or '>' after whitespace)
+    or the line before can't be in one (it has more than whitespace
+    and '/', and no tag like '<br').
+    """
+    # The line breaks in the whitespace at the end can't be told yet.
+    end = len(buf)
+    while end > scan and buf[end - 1].isspace():
+        end -= 1
+
+    # The first character after each line break that isn't
+    # whitespace, found one line at a time.
+    after = None
+    line_end = end
+    i = buf.rfind('\n', scan, end)
+    while i != -1:
+        m = _non_space.search(buf, i + 1, line_end)
+        if m is not None:
+            after = m.start()
+        if buf[after] not in '/>':
+            return i + 1, end
+        line = buf[buf.rfind('\n', 0, i) + 1:i]
+        if line.replace('/', '').strip() and not _single_tag_start.search(line):
+            return i + 1, end
+        line_end = i
+        i = buf.rfind('\n', scan, i)
+
+    return None, end
+
+
+def _normalize(source, sanitize):
+    """Strip, zap carriage returns and sanitize a text in one pass.
+
+    <source> is a string, or a file object or mmap, and is read in
+    pieces of _READ_SIZE. Each piece gets all the fixes while it's
+    still in the cache, with <sanitize> (Textiler.sanitize()) last, so
+    there is no copy of the whole text between the steps: only the
+    fixed pieces and the result are kept.
+    """
+    return ''.join([sanitize(piece) for piece in _read_cut(source, _fix_cut, _CUT_WINDOW)])
+
+
+def _block_cut(buf, scan):
+    """The last block separator <buf> can be cut at when streaming,
+    see _read_cut().
+
+    The text after it must not start with something that
+    Textiler.sanitize() or Textiler.grab_links() could join with the
+    text before it.
+    """
+    cut = None
+    for m in _block_separator.finditer(buf, scan):
+        scan = m.start()
+        end = m.end()
+        if end == len(buf):
+            return cut, scan
+        line = buf.rfind('\n', 0, m.start()) + 1
+        if buf[end] not in '[>/' and buf[line] != '[':
+            cut = end
+
+    # Whitespace at the end may become a separator.
+    end = len(buf)
+    while end > scan and buf[end - 1].isspace():
+        end -= 1
+
+    return cut, end
+
+
+def _block_spans(text):
+    """The blocks and separators of <text>, without copying them.
+
+    Yields (start, end, kind) in the order _block_separator.split()
+    would give them, with kind 'block' or 'separator', leaving out
+    empty blocks. Like split(), the last line break of a separator
+    comes again after it, as the group _block_separator captures.
+    """
+    start = 0
+    for m in _block_separator.finditer(text):
+        if start < m.start():
+            yield start, m.start(), 'block'
+        yield m.start(), m.end(), 'separator'
+        yield m.start(2), m.end(2), 'separator'
+        start = m.end()
+
+    if start < len(text):
+        yield start, len(text), 'block'
+
+
+class _Block(object):
+    """A block found by Textiler.split_text().
+
+    A long text has many blocks, so a block only keeps where it is in
+    the text and the match of its signature, and its captures are only
+    copied when they're needed. It unpacks like the [function,
+    captures] pair for the block:
+
+        for function, captures in blocks:
+            html = function(**captures)
+
+    <match> is the match of the signature of the block, or None for a
+    paragraph without one, and <changes> has the captures that are
+    not as matched (like the header with the offset), or is None.
+    """
+    __slots__ = ('function', 'match', 'text', 'start', 'end', 'changes')
+
+    def __init__(self, function, match, text, start, end, changes=None):
+        self.function = function
+        self.match = match
+        self.text = text
+        self.start = start
+        self.end = end
+        self.changes = changes
+
+
+    def captures(self):
+        """The arguments for the function, in a new dictionary."""
+        if self.match is None:
+            captures = {'text': self.text[self.start:self.end]}
+        else:
+            captures = self.match.groupdict()
+            captures.pop('dot', None)
+            captures.pop('extend', None)
+
+        if self.changes:
+            captures.update(self.changes)
+
+        return captures
+
+
+    def extend(self, more):
+        """Add the pieces in <more> to the text of the block."""
+        if more:
+            changes = self.changes or {}
+            changes['text'] = ''.join([self.captures()['text']] + more)
+            self.changes = changes
+
+        return self
+
+
+    def __iter__(self):
+        return iter((self.function, self.captures()))
+
+
+# Quick tags, in the order they are applied. Each one has the regular
+# expression for its delimiter ('qf') and for the characters its text
+# can't start with ('cls').
+qtags = [('**', 'b',      {'qf': '(?<!\*)\*\*(?!\*)', 'cls': '\*'}),
+         ('__', 'i',      {'qf': '(?<!_)__(?!_)', 'cls': '_'}),
+         ('??', 'cite',   {'qf': '\?\?(?!\?)', 'cls': '\?'}),
+         ('-',  'del',    {'qf': '(?<!\-)\-(?!\-)', 'cls': '-'}),
+         ('+',  'ins',    {'qf': '(?<!\+)\+(?!\+)', 'cls': '\+'}),
+         ('*',  'strong', {'qf': '(?<!\*)\*(?!\*)', 'cls': '\*'}),
+         ('_',  'em',     {'qf': '(?<!_)_(?!_)', 'cls': '_'}),
+         ('++', 'big',    {'qf': '(?<!\+)\+\+(?!\+)', 'cls': '\+\+'}),
+         ('--', 'small',  {'qf': '(?<!\-)\-\-(?!\-)', 'cls': '\-\-'}),
+         ('~',  'sub',    {'qf': '(?<!\~)\~(?!(\\\/~))', 'cls': '\~'}),
+         ('@',  'code',   {'qf': '(?<!@)@(?!@)', 'cls': '@'}),
+         ('%',  'span',   {'qf': '(?<!%)%(?!%)', 'cls': '%'}),
+        ]
+
+
+def _build_qtag_pattern(redict):
+    """Compile the regular expression for a quick tag."""
+    d = res.copy()
+    d.update(redict)
+
+    # This is from the perl version of Textile.
+    return re.compile(r'''(?:                          #
+                             ^                        # Start of string
+                             |                        #
+                             (?<=[\s>'"])             # Whitespace, end of tag, quotes
+                             |                        #
+                             (?P<pre>[{[])            # Surrounded by [ or {
+                             |                        #
+                             (?<=%(punct)s)           # Punctuation
+                         )                            #
+                         %(qf)s                       # opening tag
+                         %(qattr)s                    # attributes
+                         (?P<text>[^%(cls)s\s].*?)    # text
+                         (?<=\S)                      # non-whitespace
+                         %(qf)s                       # 
+                         (?:                          #
+                             $                        # End of string
+                             |                        #
+                             (?P<post>[\]}])          # Surrounded by ] or }
+                             |                        # 
+                             (?=%(punct)s{1,2}|\s)    # punctuation
+                          )                           #
+                       ''' % d, re.VERBOSE)
+
+
+def _build_qtag_close(redict):
+    """Compile the regular expression for the closing delimiter of a
+    quick tag, as _build_qtag_pattern() matches it, without consuming it."""
+    d = res.copy()
+    d.update(redict)
+
+    return re.compile(r'''(?=(?<=\S)%(qf)s(?:$|[\]}]|(?=%(punct)s{1,2}|\s)))''' % d)
+
+_qtag_patterns = [(qtag, htmltag, _build_qtag_pattern(redict), _build_qtag_close(redict))
+                  for qtag, htmltag, redict in qtags]
+
+
+def _qtag_sub(qtag, p, close, replace, text):
+    """p.sub(replace, text) for the pattern p of a quick tag, in linear time.
+
+    The text of a quick tag is matched up to the end of its line, so a
+    line with many opening delimiters and no closing one takes
+    quadratic time. We find the closing delimiters once, and only
+    try the pattern where the line has one after the opening
+    delimiter. Attributes between '(' or '{' can span lines, so we
+    also try it where they might.
+    """
+    if text.count(qtag) <= _SCAN_LIMIT:
+        return p.sub(replace, text)
+
+    closes = [m.start() for m in close.finditer(text)]
+    if not closes:
+        return text
+
+    size = len(qtag)
+    last_paren = text.rfind(')')
+    last_brace = text.rfind('}')
+
+    pieces = []
+    pos = 0
+    i = 0
+    line_end = -1
+    unclosed = -1
+    q = text.find(qtag)
+    while q != -1:
+        # The first closing delimiter the text could end at.
+        while i < len(closes) and closes[i] <= q + size:
+            i += 1
+        if i == len(closes):
+            break
+
+        if q > line_end:
+            line_start = text.rfind('\n', 0, q) + 1
+            line_end = text.find('\n', q)
+            if line_end == -1:
+                line_end = len(text)
+
+            # The last '(' or '{' in the line that isn't closed in it,
+            # if it is closed in a later line.
+            unclosed = -1
+            paren = text.rfind('(', line_start, line_end)
+            if paren != -1 and last_paren > line_end and text.find(')', paren, line_end) == -1:
+                unclosed = paren
+            brace = text.rfind('{', line_start, line_end)
+            if brace != -1 and last_brace > line_end and text.find('}', brace, line_end) == -1:
+                unclosed = max(unclosed, brace)
+
+        after = q + size
+        m = None
+        if closes[i] < line_end or (unclosed >= after and text[after:after + 1] in ('(', '[', '{')):
+            if q > pos and text[q - 1] in ('[', '{'):
+                m = p.match(text, q - 1)
+            if m is None and q >= pos:
+                m = p.match(text, q)
+
+        if m is not None:
+            pieces.append(text[pos:m.start()])
+            pieces.append(replace(m))
+            pos = m.end()
+            q = text.find(qtag, pos)
+        else:
+            q = text.find(qtag, q + 1)
+
+    if not pieces:
+        return text
+
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+# Characters used as quick tag delimiters.
+_qtag_delimiters = re.compile(r'''[-*_?+~@%^]''')
+
+# Inline formatting stages, in the order Textiler.format() applies
+# them, with the characters that must be in the text for the stage to
+# change it: a quick tag needs its delimiter, an image needs a '!', a
+# link a ':', an acronym a '(' and a caps span an upper-case letter.
+# Glyphs need quotes, dashes, dots, digits and so on, or a URL or
+# email address to linkify.
+_format_stages = [
+    ('qtags',   frozenset('-*_?+~@%^$')),
+    ('images',  frozenset('!')),
+    ('links',   frozenset(':')),
+    ('acronym', frozenset('(ABCDEFGHIJKLMNOPQRSTUVWXYZ')),
+    ('glyphs',  frozenset('{`\xb4-\'".([0123456789:@')),
+]
+
+# Characters that a stage only looks for with a feature.
+_feature_stages = [
+    ('itex',   'qtags',   '$'),
+    ('caps',   'acronym', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'),
+    ('macros', 'glyphs',  '{'),
+]
+
+# How many times each stage ran and was skipped while STATS is on,
+# see stage_stats().
+_stage_counts = dict([(name, [0, 0]) for (name, chars) in _format_stages])
+
+# A paragraph without any of these is plain prose, which only glyphs
+# can change: no quick tags, images, links, acronyms, caps, macros,
+# HTML or escaped parts.
+_markup = re.compile(r'''[-*_?+~@%^$!:(=<{`\xb4]|[A-Z]{3}''')
+
+# How many paragraphs were plain and how many needed the full inline
+# formatting while STATS is on, see paragraph_stats().
+_paragraph_counts = [0, 0]
+
+# Escaped parts of inline text, ==like this==.
+_notextile = re.compile(r'''==(.*?)==''')
+_notextile_split = re.compile(r'''(==.*?==)''')
+_notextile_match = re.compile(r'''==.*?==''')
+
+# Inline itex and superscript.
+_itex_inline = re.compile(r'''\$(.*?)\$''')
+_itex_block = re.compile(r'''^\\\[.*?\\\]''', re.MULTILINE | re.DOTALL)
+_superscript = re.compile(r'''(?<!\^)\^(?!\^)(.+?)(?<!\^)\^(?!\^)''')
+
+# Glyphs. The original sixteen substitutions are merged into a single
+# alternation, one group per glyph, in the order they used to be applied.
+# Quotes, dashes and symbols don't overlap once the lookarounds below are
+# added, so one scan gives the same result as running them one by one.
+# The leading lookahead lets most positions fail with a single test.
+_glyph_pattern = re.compile(r'''(?=[-'".\d(\[]|\s[-.(])'''
+                            r'''(?:((?<=\w)')|'''       # 1: single quote after a word
+                            r'''('(?=\w))|'''           # 2: single quote before a word
+                            r'''(')|'''                 # 3: single single quote
+                            r'''("(?=\w))|'''           # 4: double quotes
+                            r'''(")|'''                 # 5: double quotes
+                            r'''((?:\b|^) ?\.{3})|'''   # 6: ellipsis
+                            r'''(\b---\b)|'''           # 7: double em dash
+                            r'''(\s?--\s?)|'''          # 8: em dash
+                            r'''(\d+(?:(?:-| ?x ?)\d+)+(?:-(?=[^\w-]))?|\d+-(?=[^\w-]))|''' # 9: numbers
+                            r'''(\s-\s(?!--))|'''       # 10: en dash
+                            r'''(\b ?\((?:tm|TM)\))|''' # 11: trademark
+                            r'''(\b ?\([rR]\))|'''      # 12: registered
+                            r'''(\b ?\([cC]\))|'''      # 13: copyright
+                            r'''(\[\d+\]))''')          # 14: footnote
+
+_glyph_replacements = [None,
+                       '&#8217;', '&#8216;', '&#8217;', '&#8220;', '&#8221;',
+                       '&#8230;', '&#8212;&#8212;', '&#8212;', None,
+                       ' &#8211; ', '&#8482;', '&#174;', '&#169;', None]
+
+_GLYPH_EM_DASH = 8
+_GLYPH_NUMBERS = 9
+_GLYPH_FOOTNOTE = 14
+
+# Dashes and dimension signs between numbers depend on each other, so a
+# run of numbers still gets them applied in the original order.
+_number_glyphs = [(re.compile(r'''(\d+)-(\d+)'''), r'''\1&#8211;\2'''),   # en dash (1954-1999)
+                  (re.compile(r'''(\d+)-$'''), r'''\1&#8212;'''),         # em dash (1954--)
+                  (re.compile(r'''(\d+) ?x ?(\d+)'''), r'''\1&#215;\2'''), # dimension sign
+                 ]
+
+_whitespace = re.compile(r'''\s''')
+
+# Macros, HTML tags and links.
+_macro = re.compile(r'''{([^}]+)}''')
+_html_tag = re.compile(r'''(<.*?>)''')
+
+# A '<' without a '>' after it in its line, see _split_tags(). It can
+# only start at a '>', a line break or the start of the text, and reads
+# up to the next one, so it takes linear time.
+_unclosed_tag = re.compile(r'''(?:^|[>\n])[^<>\n]*<[^>\n]*(?:\n|\Z)''')
+
+# A tag, or the rest of the line after a '<' without a '>'.
+_tag_or_unclosed = re.compile(r'''(<[^>\n]*>)|<[^>\n]*''')
+
+_url = re.compile(r'''(?=[a-zA-Z0-9./#])                          # Must start correctly
+                  ((?:                                        # Match the leading part (proto://hostname, or just hostname)
+                      (?:ftp|https?|telnet|nntp)              #     protocol
+                      ://                                     #     ://
+                      (?:                                     #     Optional 'username:password@'
+                          \w+                                 #         username
+                          (?::\w+)?                           #         optional :password
+                          @                                   #         @
+                      )?                                      # 
+                      [-\w]+(?:\.\w[-\w]*)+                   #     hostname (sub.example.com)
+                  )                                           #
+                  (?::\d+)?                                   # Optional port number
+                  (?:                                         # Rest of the URL, optional
+                      /?                                      #     Start with '/'
+                      [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]*       #     Can't start with these
+                      (?:                                     #
+                          [.!,?;:]+                           #     One or more of these
+                          [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]+   #     Can't finish with these
+                          #'"                                 #     # or ' or "
+                      )*                                      #
+                  )?)                                         #
+               ''', re.VERBOSE)
+_email = re.compile(r'''(?:mailto:)?            # Optional mailto:
+                    ([-\+\w]+               # username
+                    \@                      # at
+                    [-\w]+(?:\.\w[-\w]*)+)  # hostname
+                 ''', re.VERBOSE)
+
+# Images, links, acronyms and footnotes.
+_image_pattern = re.compile(r'''\!               # Opening !
+                                %(iattr)s        # Image attributes
+                                (?P<src>%(url)s) # Image src
+                                \s?              # Optional whitesapce
+                                (                #
+                                    \(           #
+                                    (?P<alt>.*?) # Optional (alt) attribute
+                                    \)           #
+                                )?               #
+                                \s?              # Optional whitespace
+                                %(resize)s       # Resize parameters
+                                \!               # Closing !
+                                (                # Optional link
+                                    :            #    starts with ':'
+                                    (?P<link>    #    
+                                    %(url)s      #    link HREF
+                                    )            #
+                                )?               #
+                             ''' % res, re.VERBOSE)
+
+_link_patterns = [re.compile(r'''\[                           # [
+                                 (?P<quote>"|')               # Opening quotes
+                                 %(lattr)s                    # Link attributes
+                                 (?P<text>[^"]+?)             # Link text
+                                 \s?                          # Optional whitespace
+                                 (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
+                                 (?P=quote)                   # Closing quotes
+                                 :                            # :
+                                 (?P<href>[^\]]+)             # HREF
+                                 \]                           # ]
+                              ''' % res, re.VERBOSE),
+                  re.compile(r'''(?P<quote>"|')               # Opening quotes
+                                 %(lattr)s                    # Link attributes
+                                 (?P<text>[^"]+?)             # Link text
+                                 \s?                          # Optional whitespace
+                                 (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
+                                 (?P=quote)                   # Closing quotes
+                                 :                            # :
+                                 (?P<href>%(url)s)            # HREF
+                              ''' % res, re.VERBOSE),
+                 ]
+
+_acronym = re.compile(r'''(?P<acronym>[\w]+)\((?P<definition>[^\(\)]+?)\)''')
+_acronym_caps = re.compile(r'''[A-Z\d]+''')
+
+_footnote_paragraph = re.compile(r'''<p class="footnote" id="fn(?P<n>\d+)"><sup>(?P=n)</sup>(?P<note>.*)</p>''')
+_footnote_reference = re.compile(r'''<a href="#fn(?P<n>\d+)">''')
+
+
+class _Pattern:
+    """A pattern used by preg_replace().
+
+    Keeps the compiled pattern, its replacements already parsed, and
+    how many times it was used and for how long (if STATS is on).
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.replacements = {}
+        self.calls = 0
+        self.time = 0.0
+
+
+    def replacement(self, replacement):
+        """Parsed replacement, to be passed to regex.sub().
+
+        References to groups (\\1 to \\9) are replaced with the
+        group, or with '' if the group didn't match. A replacement
+        without references is used as it is.
+        """
+        try:
+            return self.replacements[replacement]
+        except KeyError:
+            pass
+
+        # Split in literals and group numbers: [literal, group, literal...]
+        parts = _group_reference.split(replacement)
+        literals = [parts[0]]
+        groups = []
+        for i in range(1, len(parts), 2):
+            group = int(parts[i])
+            if group <= self.regex.groups:
+                groups.append(group)
+                literals.append(parts[i+1])
+            else:
+                literals[-1] = ''.join([literals[-1], '\\', parts[i], parts[i+1]])
+
+        if not groups:
+            # Escape it, so the re module takes it literally.
+            func = literals[0].replace('\\', r'\\')
+        else:
+            def func(matchobj):
+                if DEBUGLEVEL: _debug(matchobj.groups())
+                out = [literals[0]]
+                for group, literal in zip(groups, literals[1:]):
+                    out.append(matchobj.group(group) or '')
+                    out.append(literal)
+                return ''.join(out)
+
+        self.replacements[replacement] = func
+        return func
+
+
+# Patterns used by preg_replace(), by pattern. They are compiled on
+# first use and kept forever; the engine uses a few dozens.
+_patterns = {}
+
+_group_reference = re.compile(r'''\\([1-9])''')
+
+
+def _get_pattern(pattern):
+    """Returns the _Pattern for a pattern, compiling it if needed."""
+    p = _patterns.get(pattern)
+    if p is None:
+        _debug(pattern)
+        p = _patterns[pattern] = _Pattern(pattern)
+    return p
+
+
+def pattern_stats():
+    """Statistics of the patterns used by preg_replace().
+
+    Returns a list of (seconds, calls, pattern) with the total time
+    spent in each pattern and how many times it was used, slowest
+    first. The time is only measured while STATS is on. The counters
+    are not locked, so they may miss a few calls when rendering from
+    several threads at once.
+    """
+    stats = [(p.time, p.calls, p.pattern) for p in _patterns.values()]
+    stats.sort(reverse=True)
+    return stats
+
+
+def _get_features(features):
+    """The set of features named by a profile or a list of features."""
+    if isinstance(features, basestring):
+        try:
+            return _profiles[features]
+        except KeyError:
+            raise ValueError("unknown profile '%s'" % features)
+
+    features = frozenset(features)
+    unknown = features - _all_features
+    if unknown:
+        raise ValueError("unknown feature(s): %s" % ', '.join(sorted(unknown)))
+
+    return features
+
+
+def _pruned_stages(features):
+    """The stages of Textiler.format() for a set of features.
+
+    A stage doesn't look for the characters used only by the
+    features that are off, so it's skipped more often.
+    """
+    if features == _all_features:
+        return _format_stages
+
+    stages = []
+    for name, chars in _format_stages:
+        for feature, stage, feature_chars in _feature_stages:
+            if stage == name and feature not in features:
+                chars = chars - frozenset(feature_chars)
+        stages.append((name, chars))
+
+    return stages
+
+
+# Equations converted by itex2mml, by equation, and how many of them
+# are kept.
+_itex_results = {}
+_ITEX_RESULTS_SIZE = 1000
+
+# Line between the equations sent to itex2mml in a single run. It
+# passes text without math untouched.
+_ITEX_SEPARATOR = 'textile-itex-separator\n'
+
+
+def _run_itex2mml(text):
+    """Run itex2mml on <text> and return its output.
+
+    The text goes to the standard input, so equations can have any
+    characters. Returns None if itex2mml can't be run.
+    """
+    try:
+        p = subprocess.Popen(itex2mml, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return p.communicate(text)[0]
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def _convert_itex(equations):
+    """Convert equations to MathML with itex2mml.
+
+    All the equations not converted before are sent to itex2mml at
+    once, one per line with a separator line after each. Each
+    equation is converted as if it were alone, as "echo equation |
+    itex2mml" would do. Returns the MathML by equation; if the output
+    can't be split back, the new equations are left out, and itex()
+    converts them one by one.
+
+    The results are also kept in _itex_results, dropping as many
+    older ones as needed to make room for them.
+    """
+    converted = {}
+    todo = []
+    seen = {}
+    for equation in equations:
+        if equation in seen or _ITEX_SEPARATOR in equation:
+            continue
+        seen[equation] = 1
+        mathml = _itex_results.get(equation)
+        if mathml is None:
+            todo.append(equation)
+        else:
+            converted[equation] = mathml
+    if not todo:
+        return converted
+
+    output = _run_itex2mml(''.join([equation + '\n' + _ITEX_SEPARATOR for equation in todo]))
+    if output is None:
+        return converted
+
+    results = output.split(_ITEX_SEPARATOR)
+    if len(results) != len(todo) + 1 or results[-1]:
+        return converted
+
+    new = zip(todo, results)
+    converted.update(new)
+
+    # Another thread may be storing results too, so the dict can be
+    # emptied under us.
+    new = new[-_ITEX_RESULTS_SIZE:]
+    try:
+        for i in range(len(_itex_results) + len(new) - _ITEX_RESULTS_SIZE):
+            _itex_results.popitem()
+    except KeyError:
+        pass
+    _itex_results.update(new)
+
+    return converted
+
+
+def stage_stats():
+    """Statistics of the inline formatting stages.
+
+    Returns a list of (stage, runs, skipped), in the order the stages
+    are applied: how many times each stage ran, and how many times
+    it was skipped because the text didn't have the characters it
+    looks for. They are only counted while STATS is on, and like
+    pattern_stats(), the counters are not locked.
+    """
+    return [(name, _stage_counts[name][0], _stage_counts[name][1]) for (name, chars) in _format_stages]
+
+
+def paragraph_stats():
+    """Statistics of the paragraphs.
+
+    Returns (plain, formatted): how many paragraphs were plain prose
+    and took the short path in Textiler.paragraph(), and how many
+    needed the full inline formatting. They are only counted while
+    STATS is on.
+    """
+    return tuple(_paragraph_counts)
+
 
 def preg_replace(pattern, replacement, text):
     """Alternative re.sub that handles empty groups.
@@ -456,24 +1672,72 @@ def preg_replace(pattern, replacement, text):
     This acts like re.sub, except it replaces empty groups with ''
     instead of raising an exception.
     """
+    p = _get_pattern(pattern)
+    if STATS:
+        start = time.time()
+        text = p.regex.sub(p.replacement(replacement), text)
+        p.time += time.time() - start
+    else:
+        text = p.regex.sub(p.replacement(replacement), text)
+    p.calls += 1
 
-    def replacement_func(matchobj):
-        counter = 1
-        rc = replacement
-        _debug(matchobj.groups())
-        for matchitem in matchobj.groups():
-            if not matchitem:
-                matchitem = ''
+    return text
 
-            rc = rc.replace(r'\%s' % counter, matchitem)
-            counter += 1
 
-        return rc
-        
-    p = re.compile(pattern)
-    _debug(pattern)
+def _split_tags(text):
+    """_html_tag.split(text), in linear time.
+
+    _html_tag looks for a '>' after each '<' up to the end of the
+    line, so a long line with many '<' and no '>' after them takes
+    quadratic time. A text with such a '<' is split here instead,
+    where the rest of its line is skipped at once.
+    """
+    if text.count('<') <= _SCAN_LIMIT or not _unclosed_tag.search(text):
+        return _html_tag.split(text)
+
+    pieces = []
+    start = 0
+    for m in _tag_or_unclosed.finditer(text):
+        tag = m.group(1)
+        if tag is not None:
+            pieces.append(text[start:m.start()])
+            pieces.append(tag)
+            start = m.end()
+    pieces.append(text[start:])
+
+    return pieces
+
+
+def _join_broken_tags(text):
+    """Remove <br /> from inside broken HTML tags.
+
+    This is preg_replace(r'(<[^>]*)<br />\\n(.*?>)', r'\\1 \\2', text),
+    in linear time: that one looks for a '>' after each '<', so many
+    '<' without a '>' take quadratic time. Here we start from each
+    '<br />\\n' instead, and look for the '<' before it and the '>'
+    after it.
+    """
+    k = text.find('<br />\n')
+    if k == -1:
+        return text
+
+    pieces = []
+    pos = 0
+    while k != -1:
+        # The tag starts at the first '<' after the last '>'.
+        start = text.find('<', max(pos, text.rfind('>', pos, k) + 1), k)
+        end = text.find('>', k + 7)
+        if start != -1 and end != -1 and text.find('\n', k + 7, end) == -1:
+            pieces.append(text[pos:k])
+            pieces.append(' ')
+            pieces.append(text[k + 7:end + 1])
+            pos = end + 1
+            k = text.find('<br />\n', pos)
+        else:
+            k = text.find('<br />\n', k + 7)
 
-    return p.sub(replacement_func, text)
+    pieces.append(text[pos:])
+    return ''.join(pieces)
 
 
 def html_replace(pattern, replacement, text):
@@ -482,27 +1746,43 @@ def html_replace(pattern, replacement, text):
     Does a preg_replace only outside HTML tags.
     """
     # If there is no html, do a simple search and replace.
-    if not re.search(r'''<.*>''', text):
+    if '<' not in text:
         return preg_replace(pattern, replacement, text)
 
     else:
+        # The text between tags can be a lot of little pieces (think
+        # of a nested list), so look up the pattern only once.
+        if STATS:
+            start = time.time()
+        p = _get_pattern(pattern)
+        sub = p.regex.sub
+        replacement = p.replacement(replacement)
+
         lines = []
         # Else split the text into an array at <>.
-        for line in re.split('(<.*?>)', text):
-            if not re.match('<.*?>', line):
-                line = preg_replace(pattern, replacement, line)
+        for line in _split_tags(text):
+            if not (line.startswith('<') and _html_tag.match(line)):
+                line = sub(replacement, line)
 
             lines.append(line)
 
+        p.calls += 1
+        if STATS:
+            p.time += time.time() - start
+
         return ''.join(lines)
 
 
 # PyTextile can optionally sanitize the generated XHTML,
 # which is good for weblog comments. This code is from
 # Mark Pilgrim's feedparser.
+def _charref(m):
+    return unichr(int(m.group(1)))
+
+
 class _BaseHTMLProcessor(sgmllib.SGMLParser):
-    elements_no_end_tag = ['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
-      'img', 'input', 'isindex', 'link', 'meta', 'param']
+    elements_no_end_tag = frozenset(['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
+      'img', 'input', 'isindex', 'link', 'meta', 'param'])
     
     def __init__(self):
         sgmllib.SGMLParser.__init__(self)
@@ -511,11 +1791,29 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
         self.pieces = []
         sgmllib.SGMLParser.reset(self)
 
+    def finish_starttag(self, tag, attrs):
+        # There are no start_ or do_ methods, so every tag is unknown
+        # and SGMLParser would only look them up to find that out.
+        self.unknown_starttag(tag, attrs)
+        return -1
+
+    def finish_endtag(self, tag):
+        # Same here with end_ methods. Unknown tags are never pushed
+        # on the stack, so there's nothing to close either.
+        self.unknown_endtag(tag)
+
     def normalize_attrs(self, attrs):
         # utility method to be called by descendants
-        attrs = [(k.lower(), sgmllib.charref.sub(lambda m: unichr(int(m.groups()[0])), v).strip()) for k, v in attrs]
-        attrs = [(k, k in ('rel', 'type') and v.lower() or v) for k, v in attrs]
-        return attrs
+        normalized = []
+        for k, v in attrs:
+            k = k.lower()
+            if '&#' in v:
+                v = sgmllib.charref.sub(_charref, v)
+            v = v.strip()
+            if k == 'rel' or k == 'type':
+                v = v.lower()
+            normalized.append((k, v))
+        return normalized
     
     def unknown_starttag(self, tag, attrs):
         # called for each start tag
@@ -523,25 +1821,25 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
         # e.g. for <pre class="screen">, tag="pre", attrs=[("class", "screen")]
         strattrs = "".join([' %s="%s"' % (key, value) for key, value in attrs])
         if tag in self.elements_no_end_tag:
-            self.pieces.append("<%(tag)s%(strattrs)s />" % locals())
+            self.pieces.append("<%s%s />" % (tag, strattrs))
         else:
-            self.pieces.append("<%(tag)s%(strattrs)s>" % locals())
+            self.pieces.append("<%s%s>" % (tag, strattrs))
         
     def unknown_endtag(self, tag):
         # called for each end tag, e.g. for </pre>, tag will be "pre"
         # Reconstruct the original end tag.
         if tag not in self.elements_no_end_tag:
-            self.pieces.append("</%(tag)s>" % locals())
+            self.pieces.append("</%s>" % tag)
 
     def handle_charref(self, ref):
         # called for each character reference, e.g. for "&#160;", ref will be "160"
         # Reconstruct the original character reference.
-        self.pieces.append("&#%(ref)s;" % locals())
+        self.pieces.append("&#%s;" % ref)
 
     def handle_entityref(self, ref):
         # called for each entity reference, e.g. for "&copy;", ref will be "copy"
         # Reconstruct the original entity reference.
-        self.pieces.append("&%(ref)s;" % locals())
+        self.pieces.append("&%s;" % ref)
 
     def handle_data(self, text):
         # called for each block of plain text, i.e. outside of any tag and
@@ -552,24 +1850,35 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
     def handle_comment(self, text):
         # called for each HTML comment, e.g. <!-- insert Javascript code here -->
         # Reconstruct the original comment.
-        self.pieces.append("<!--%(text)s-->" % locals())
+        self.pieces.append("<!--%s-->" % text)
 
     def handle_pi(self, text):
         # called for each processing instruction, e.g. <?instruction>
         # Reconstruct original processing instruction.
-        self.pieces.append("<?%(text)s>" % locals())
+        self.pieces.append("<?%s>" % text)
 
     def handle_decl(self, text):
         # called for the DOCTYPE, if present, e.g.
         # <!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"
         #     "http://www.w3.org/TR/html4/loose.dtd">
         # Reconstruct original DOCTYPE
-        self.pieces.append("<!%(text)s>" % locals())
+        self.pieces.append("<!%s>" % text)
 
     def output(self):
         """Return processed HTML as a single string"""
         return "".join(self.pieces)
 
+    def process(self, text):
+        """Process a chunk of HTML and return the result.
+
+        The HTML can come in chunks of any size. A construct cut at
+        the end of a chunk is kept until the next one.
+        """
+        self.feed(text)
+        text = self.output()
+        self.pieces = []
+        return text
+
 
 class _HTMLSanitizer(_BaseHTMLProcessor):
     acceptable_elements = ['a', 'abbr', 'acronym', 'address', 'area', 'b', 'big',
@@ -592,14 +1901,14 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
       'span', 'src', 'start', 'summary', 'tabindex', 'target', 'title', 'type',
       'usemap', 'valign', 'value', 'vspace', 'width']
     
-    unacceptable_elements_with_end_tag = ['script', 'applet'] 
+    unacceptable_elements_with_end_tag = frozenset(['script', 'applet'])
     
     # This if for MathML.
     mathml_elements = ['math', 'mi', 'mn', 'mo', 'mrow', 'msup']
     mathml_attributes = ['mode', 'xmlns']
 
-    acceptable_elements = acceptable_elements + mathml_elements
-    acceptable_attributes = acceptable_attributes + mathml_attributes
+    acceptable_elements = frozenset(acceptable_elements + mathml_elements)
+    acceptable_attributes = frozenset(acceptable_attributes + mathml_attributes)
                   
     def reset(self):
         _BaseHTMLProcessor.reset(self)
@@ -610,8 +1919,9 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             if tag in self.unacceptable_elements_with_end_tag:
                 self.unacceptablestack += 1
             return
+        acceptable = self.acceptable_attributes
+        attrs = [(key, value) for key, value in attrs if key.lower() in acceptable]
         attrs = self.normalize_attrs(attrs)
-        attrs = [(key, value) for key, value in attrs if key in self.acceptable_attributes]
         _BaseHTMLProcessor.unknown_starttag(self, tag, attrs)
 
     def unknown_endtag(self, tag):
@@ -629,175 +1939,450 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
 
     def handle_data(self, text):
         if not self.unacceptablestack:
-            _BaseHTMLProcessor.handle_data(self, text)
+            self.pieces.append(text)
+
+
+class BlockCache:
+    """Cache of rendered blocks.
+
+    This class keeps the HTML of each block in a SQLite database,
+    so unchanged blocks don't have to be rendered again. The cache
+    can be stored in a file, in a directory (as textile-cache.db)
+    or in memory if no path is given:
+
+        cache = BlockCache('/var/cache/blog')
+        html = textile(text, cache=cache)
+
+    When there are more than <size> blocks, the least recently used
+    ones are removed. The number of hits and misses is counted in
+    the attributes of the same name.
+
+    A cache can be shared by many threads.
+    """
+    def __init__(self, path=None, size=CACHE_SIZE):
+        if sqlite3 is None:
+            raise ImportError('BlockCache needs the sqlite3 module')
+        if path is None:
+            path = ':memory:'
+        elif os.path.isdir(path):
+            path = os.path.join(path, 'textile-cache.db')
+        self.path = path
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._closed = False
+        self._db.execute('CREATE TABLE IF NOT EXISTS blocks (key TEXT PRIMARY KEY, html BLOB, used INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)')
+
+        # Blocks are stamped with an increasing counter when used. The
+        # stamps of the blocks read are written when flushing, so reading
+        # doesn't keep the database locked.
+        self._clock = self._db.execute('SELECT MAX(used) FROM blocks').fetchone()[0] or 0
+        self._used = {}
+        self._count = self._db.execute('SELECT COUNT(*) FROM blocks').fetchone()[0]
+
+
+    def get(self, key):
+        """Return the HTML stored for <key>, or None."""
+        self._lock.acquire()
+        try:
+            row = self._db.execute('SELECT html FROM blocks WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._clock += 1
+            self._used[key] = self._clock
+            return str(row[0])
+        finally:
+            self._lock.release()
+
+
+    def put(self, key, html):
+        """Store the HTML for <key>, evicting old blocks if needed."""
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._used.pop(key, None)
+            if self._db.execute('INSERT OR IGNORE INTO blocks VALUES (?, ?, ?)', (key, buffer(html), self._clock)).rowcount:
+                self._count += 1
+            else:
+                self._db.execute('UPDATE blocks SET html = ?, used = ? WHERE key = ?', (buffer(html), self._clock, key))
+
+            excess = self._count - self.size
+            if excess > 0:
+                self._write_used()
+                self._db.execute('DELETE FROM blocks WHERE key IN (SELECT key FROM blocks ORDER BY used LIMIT ?)', (excess,))
+                self._count -= excess
+        finally:
+            self._lock.release()
+
+
+    def hit_rate(self):
+        """Return the fraction of lookups that were hits."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+
+    def _write_used(self):
+        """Write the stamps of the blocks read since the last time."""
+        if self._used:
+            self._db.executemany('UPDATE blocks SET used = ? WHERE key = ?', [(used, key) for key, used in self._used.items()])
+            self._used = {}
+
+
+    def flush(self):
+        """Write the changes to disk."""
+        self._lock.acquire()
+        try:
+            self._write_used()
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+
+    def close(self):
+        """Write the changes and close the database, if still open."""
+        self._lock.acquire()
+        try:
+            if not self._closed:
+                self._write_used()
+                self._db.commit()
+                self._db.close()
+                self._closed = True
+        finally:
+            self._lock.release()
+
+
+# The cache opened for COLOR_CACHE, with its path and the process that
+# opened it, since a process must not use the database of another one.
+_color_cache = None
+_color_cache_owner = None
+_color_cache_lock = threading.Lock()
+
+
+def color_cache():
+    """Return the cache of colorized code, or None.
+
+    The cache is opened the first time it's needed, from the path in
+    COLOR_CACHE. Its hits, misses and hit_rate() tell how much
+    colorizing it saved.
+    """
+    global _color_cache, _color_cache_owner
+
+    if COLOR_CACHE is None:
+        return None
+
+    _color_cache_lock.acquire()
+    try:
+        owner = (COLOR_CACHE, os.getpid())
+        if _color_cache_owner != owner:
+            # The cache for the old path is closed, unless another
+            # process opened it: that one is still using it.
+            if _color_cache is not None and _color_cache_owner[1] == owner[1]:
+                _color_cache.close()
+            path = COLOR_CACHE
+            if os.path.isdir(path):
+                path = os.path.join(path, 'textile-colors.db')
+            _color_cache = BlockCache(path)
+            _color_cache_owner = owner
+        return _color_cache
+    finally:
+        _color_cache_lock.release()
+
+
+def _cached_color(code, lang):
+    """Colorize code with _color(), using the color cache if any."""
+    cache = color_cache()
+    if cache is None:
+        return _color(code)
+
+    key = hashlib.md5(repr((__version__, lang, code))).hexdigest()
+    html = cache.get(key)
+    if html is None:
+        html = _color(code)
+        cache.put(key, html)
+
+    return html
+
+
+# The Textiler of a worker process, see _init_worker().
+_worker = None
+
+
+def _init_worker(klass, features, links, head_offset):
+    """Set up the Textiler of a worker process.
+
+    This runs once in each worker process when rendering in
+    parallel, so what all the blocks share (the Textiler class, its
+    features, the link lookups and the header offset) is sent once
+    per process instead of with each chunk.
+    """
+    global _worker
+    _worker = klass(features=features)
+    _worker._links = links
+    _worker.head_offset = head_offset
+
+
+def _render_chunk(blocks):
+    """Render a chunk of blocks.
+
+    This runs in the worker processes when rendering in parallel.
+    <blocks> is a list of (handler name, captures).
+    """
+    html = [getattr(_worker, handler)(**captures) for handler, captures in blocks]
+    _worker._flush_color_cache()
+
+    return html
+
+
+def _map_chunks(jobs, chunks, shared):
+    """Render <chunks> in a pool of <jobs> processes, in order.
+
+    <shared> has the arguments for _init_worker().
+    """
+    pool = multiprocessing.Pool(jobs, _init_worker, shared)
+    try:
+        return pool.map(_render_chunk, chunks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Revision of the HTML rendered for the same text, in the keys of a
+# BlockCache, so blocks cached by an older version are not used. It
+# must be bumped by every change to the output.
+_CACHE_FORMAT = 1
+
+
+def _block_key(function, captures, options):
+    """Return the cache key for a block.
+
+    The key is a hash of the handler, its arguments and the options
+    that change the output of a block.
+    """
+    items = captures.items()
+    items.sort()
+    return hashlib.md5(repr((function.__name__, items, options))).hexdigest()
+
+
+# The stages of Textiler timed by a StageProfile: the passes over the
+# whole text, the block handlers, the inline passes of format(), and
+# the footnotes and encoding of the output.
+_profiled_stages = ['preprocess', 'grab_links', 'split_text']
+for regexp, handler, leaders in signatures:
+    if handler not in _profiled_stages:
+        _profiled_stages.append(handler)
+_profiled_stages.extend([name for (name, chars) in _format_stages])
+_profiled_stages.extend(['footnotes', 'encode'])
+
+
+class StageProfile:
+    """Call counts and time of the stages of Textiler.
+
+    Profiling is off unless a StageProfile is given to textile() or
+    the other functions, or to a Textiler:
+
+        profile = StageProfile()
+        html = textile(text, profile=profile)
+        profile.dump_json('stages.json')
+        profile.dump_stats('stages.prof')
+
+    The stages (see _profiled_stages) are then replaced, in that
+    Textiler only, by methods that time them. When profiling is off
+    nothing is timed or even checked. A profile adds up all the
+    runs it's given to. Like a Textiler, it shouldn't be used by two
+    threads at once. Blocks rendered in other processes (jobs > 1)
+    are not timed.
+
+    textile_iter() reads, preprocesses and splits the text a piece
+    at a time between the blocks, and finds the footnotes as they
+    are rendered, so there only the block handlers, the inline
+    passes and encode are timed: preprocess, grab_links, split_text
+    and footnotes don't show up.
+
+    dump_stats() writes the format of cProfile, so the file can be
+    read with pstats.Stats(). Time spent in a stage called by another
+    one, like an inline pass called by a block handler, counts in the
+    cumulative time of both, but only in the own time of the inner
+    one.
+    """
+    def __init__(self):
+        # For each stage, [calls, calls not within itself, cumulative
+        # time, own time, callers], and for each caller (None for the
+        # Textiler itself) the same but the callers.
+        self.stages = {}
+        self._stack = []
+
+
+    def attach(self, textiler):
+        """Time the stages of <textiler>."""
+        for name in _profiled_stages:
+            setattr(textiler, name, self._timed(name, getattr(textiler, name)))
+
+
+    def _timed(self, name, method):
+        """Wrap <method> to time it as the stage <name>."""
+        stages = self.stages
+        stack = self._stack
+
+        def timed(*args, **kwargs):
+            # The stage, and the time spent in the stages it calls.
+            frame = [name, 0.0]
+            stack.append(frame)
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                stack.pop()
+                own = elapsed - frame[1]
+                caller = None
+                if stack:
+                    caller = stack[-1][0]
+                    stack[-1][1] += elapsed
+                primitive = name not in [f[0] for f in stack]
+
+                stats = stages.get(name)
+                if stats is None:
+                    stats = stages[name] = [0, 0, 0.0, 0.0, {}]
+                by_caller = stats[4].get(caller)
+                if by_caller is None:
+                    by_caller = stats[4][caller] = [0, 0, 0.0, 0.0]
+                for counts in (stats, by_caller):
+                    counts[0] += 1
+                    counts[3] += own
+                    if primitive:
+                        counts[1] += 1
+                        counts[2] += elapsed
+
+        timed.__name__ = method.__name__
+        timed.__doc__ = method.__doc__
+        return timed
+
+
+    def as_dict(self):
+        """The profile as a dictionary, by stage.
+
+        Each stage has its 'calls', 'time' (cumulative, in seconds),
+        'own_time' and 'callers', the number of calls by each stage
+        that called it ('' is the Textiler itself).
+        """
+        result = {}
+        for name, (calls, primitive, total, own, callers) in self.stages.items():
+            result[name] = {'calls': calls,
+                            'time': total,
+                            'own_time': own,
+                            'callers': dict([(caller or '', counts[0]) for caller, counts in callers.items()])}
+
+        return result
+
+
+    def dump_json(self, path):
+        """Write the profile as JSON, see as_dict()."""
+        f = open(path, 'w')
+        try:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+
+    def dump_stats(self, path):
+        """Write the profile for pstats.Stats(), like cProfile does."""
+        def key(name):
+            code = getattr(Textiler, name).im_func.func_code
+            return (code.co_filename, code.co_firstlineno, name)
+
+        stats = {}
+        for name, (calls, primitive, total, own, callers) in self.stages.items():
+            stats[key(name)] = (primitive, calls, own, total,
+                                dict([(key(caller), (c[0], c[1], c[3], c[2]))
+                                      for caller, c in callers.items() if caller is not None]))
+
+        f = open(path, 'wb')
+        try:
+            marshal.dump(stats, f)
+        finally:
+            f.close()
 
 
 class Textiler:
     """Textile formatter.
 
     This is the base class for the PyTextile text processor.
+
+    A Textiler formats a single text, and shouldn't be used by two
+    threads at once. Different instances can be used at the same time
+    from many threads: the compiled patterns and tables at the module
+    level are never changed after import (except for caches that
+    only add results of pure functions: the patterns of
+    preg_replace(), the unicode names of macros() and the equations
+    converted by itex()), and all the state of a run is kept in the
+    instance. textile() and textile_iter() create a new instance on
+    each call, so they are safe to call from any thread.
+    Configuration variables like HEAD_OFFSET should be set before the
+    threads start.
     """
-    def __init__(self, text=''):
+    def __init__(self, text='', features=FEATURES, profile=None):
         """Instantiate the class, passing the text to be formatted.
             
         Here we pre-process the text and collect all the link
-        lookups for later.
+        lookups for later. The text can be a string, or a file
+        object or mmap to read it from. <features> is a profile or a list of
+        features (see FEATURES), and the passes of the features
+        that are off are left out here. If a StageProfile is given
+        as <profile>, the stages are timed there.
         """
         self.text = text
 
-        # Basic regular expressions.
+        # Optional features.
+        self.features = _get_features(features)
+        self._stages = _pruned_stages(self.features)
+        if 'itex' in self.features:
+            self._dispatcher = _dispatcher
+        else:
+            self._dispatcher = _dispatcher_no_itex
+
+        # Basic regular expressions. They are shared, don't change them.
         self.res = res
 
+        # Parsed parameters and open tags, see parse_params() and
+        # build_open_tag().
+        self._params_memo = {}
+        self._open_tag_memo = {}
+
         # Smart searches.
         self.searches = {}
         self.searches['imdb']   = 'http://www.imdb.com/Find?for=%s'
         self.searches['google'] = 'http://www.google.com/search?q=%s'
         self.searches['python'] = 'http://www.python.org/doc/current/lib/module-%s.html'
-        if amazon_associate_id:
+        if 'searches' not in self.features:
+            self.searches = {}
+        elif amazon_associate_id:
             self.searches['isbn']   = ''.join(['http://', AMAZON, '/exec/obidos/ASIN/%s/', amazon_associate_id])
             self.searches['amazon'] = ''.join(['http://', AMAZON, '/exec/obidos/external-search?mode=blended&keyword=%s&tag=', amazon_associate_id])
         else:
             self.searches['isbn']   = ''.join(['http://', AMAZON, '/exec/obidos/ASIN/%s'])
             self.searches['amazon'] = ''.join(['http://', AMAZON, '/exec/obidos/external-search?mode=blended&keyword=%s'])
 
-        # These are the blocks we know.
-        self.signatures = [
-                           # Paragraph.
-                           (r'''^p                       # Paragraph signature
-                                %(battr)s                # Paragraph attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended paragraph denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.paragraph),
-   
-                           # Pre-formatted text.
-                           (r'''^pre                     # Pre signature
-                                %(battr)s                # Pre attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended pre denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.pre),
-   
-                           # Block code.
-                           (r'''^bc                      # Blockcode signature
-                                %(battr)s                # Blockcode attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended blockcode denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.bc),
-   
-                           # Blockquote.
-                           (r'''^bq                      # Blockquote signature
-                                %(battr)s                # Blockquote attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended blockquote denoted by a second dot
-                                (:(?P<cite>              # Optional cite attribute
-                                (                        #
-                                    %(url)s              #     URL
-                                |   "[\w]+(?:\s[\w]+)*"  #     "Name inside quotes"
-                                ))                       #
-                                )?                       #
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.blockquote),
-   
-                           # Header.
-                           (r'''^h                       # Header signature
-                                (?P<header>\d)           # Header number
-                                %(battr)s                # Header attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended header denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.header),
-   
-                           # Footnote.
-                           (r'''^fn                      # Footnote signature
-                                (?P<footnote>[\d]+)      # Footnote number
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended footnote denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''', self.footnote),
-   
-                           # Definition list.
-                           (r'''^dl                      # Definition list signature
-                                %(battr)s                # Definition list attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended definition list denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.dl),
-                           
-                           # Ordered list (attributes to first <li>).
-                           (r'''^%(olattr)s              # Ordered list attributes
-                                \#                       # Ordered list signature
-                                %(liattr)s               # List item attributes
-                                (?P<dot>\.)?             # .
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.ol),
-   
-                           # Unordered list (attributes to first <li>).
-                           (r'''^%(olattr)s              # Unrdered list attributes
-                                \*                       # Unordered list signature
-                                %(liattr)s               # Unordered list attributes
-                                (?P<dot>\.)?             # .
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.ul),
-   
-                           # Escaped text.
-                           (r'''^==?(?P<text>.*?)(==)?$  # Escaped text
-                             ''', self.escape),
-   
-                           (r'''^(?P<text><.*)$          # XHTML tag
-                             ''', self.escape),
-   
-                           # itex code.
-                           (r'''^(?P<text>               # itex code
-                                \\\[                     # starts with \[
-                                .*?                      # complicated mathematical equations go here
-                                \\\])                    # ends with \]
-                             ''', self.itex),
-   
-                           # Tables.
-                           (r'''^table                   # Table signature
-                                %(tattr)s                # Table attributes
-                                (?P<dot>\.)              # .
-                                (?P<extend>\.)?          # Extended blockcode denoted by a second dot
-                                \s                       # whitespace
-                                (?P<text>.*)             # text
-                             ''' % self.res, self.table),
-                           
-                           # Simple tables.
-                           (r'''^(?P<text>
-                                \|
-                                .*)
-                             ''', self.table),
-   
-                           # About.
-                           (r'''^(?P<text>tell\sme\sabout\stextile\.)$''', self.about),
-                          ]
+        if profile is not None:
+            profile.attach(self)
 
 
     def preprocess(self):
         """Pre-processing of the text.
 
-        Remove whitespace, fix carriage returns.
+        Remove whitespace, fix carriage returns and do the minor
+        sanitizing, all in one pass over the text. The text can also
+        be a file object or an mmap, which is read in pieces.
         """
-        # Remove whitespace.
-        self.text = self.text.strip()
-
-        # Zap carriage returns.
-        self.text = self.text.replace("\r\n", "\n")
-        self.text = self.text.replace("\r", "\n")
-
-        # Minor sanitizing.
-        self.text = self.sanitize(self.text)
+        self.text = _normalize(self.text, self.sanitize)
 
 
     def grab_links(self):
@@ -806,24 +2391,45 @@ class Textiler:
         Check the text for link lookups, store them in a 
         dictionary, and clean them up.
         """
-        # Grab links like this: '[id]example.com'
         links = {}
-        p = re.compile(r'''(?:^|\n)\[([\w]+?)\](%(url)s)(?:$|\n)''' % self.res, re.VERBOSE)
-        for key, link in p.findall(self.text):
+        self.text = self._grab_links(self.text, links)
+
+        return links
+
+
+    def _grab_links(self, text, links):
+        """Store the link lookups from <text> in <links>.
+
+        Returns the text without them.
+        """
+        # Grab links like this: '[id]example.com'
+        for key, link in _link_definition.findall(text):
             links[key] = link
 
         # And clear them from the text.
-        self.text = p.sub('', self.text)
+        return _link_definition.sub('', text)
 
-        return links
+
+    def _read_text(self, fileobj, links):
+        """Read and pre-process text from a file object.
+
+        Yields the text in pieces that end with a block separator,
+        doing the same as preprocess() and grab_links() would do on
+        the whole text. Link lookups are stored in <links>.
+        """
+        for text in _read_cut(fileobj, _block_cut):
+            yield self._grab_links(self.sanitize(text), links)
 
 
-    def process(self, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING):
+    def process(self, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, cache=None, jobs=1):
         """Process the text.
 
         Here we actually process the text, splitting the text in
         blocks and applying the corresponding function to each
-        one of them.
+        one of them. If a cache (a BlockCache, or a path for one)
+        is given, blocks found there are not rendered again. If
+        <jobs> is more than 1, the blocks are rendered in that many
+        processes, which pays off for long texts.
         """
         # Basic global changes.
         self.preprocess()
@@ -831,30 +2437,97 @@ class Textiler:
         # Grab lookup links and clean them from the text.
         self._links = self.grab_links()
 
+        # Convert all equations at once. With a cache, only the ones
+        # in the blocks it misses are converted, see _render_blocks().
+        if cache is None:
+            self._prefetch_itex(self.text)
+
         # Offset for the headers.
         self.head_offset = head_offset
 
         # Process each block.
         self.blocks = self.split_text()
 
-        text = []
-        for [function, captures] in self.blocks:
-            text.append(function(**captures))
+        return self._render_text(validate, sanitize, output, encoding, cache, jobs)
+
+
+    def parse(self):
+        """Split the text in blocks, as a document for render().
+
+        The document is what process() has before rendering the
+        blocks: a tuple with the version, the features, the link
+        lookups, the equations and a list of (handler name, captures)
+        for the blocks. The captures are as matched: the attributes
+        and the inline formatting of each block are only parsed when
+        it's rendered. The document has only tuples, lists,
+        dictionaries, strings and numbers, so it can be stored with
+        marshal or pickle. Headers keep their number without the
+        offset, which is added by render().
+        """
+        self.preprocess()
+        self._links = self.grab_links()
+        self.head_offset = 0
+
+        features = list(self.features)
+        features.sort()
+
+        blocks = [(function.__name__, captures) for function, captures in self.split_text()]
+
+        return (__version__, features, self._links, self._equations(self.text), blocks)
+
+
+    def render(self, document, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, cache=None, jobs=1):
+        """Render a document from parse().
+
+        This does what process() does after splitting the blocks, so
+        a document can be rendered many times, with different
+        options, and parsed only once. The Textiler must have the
+        features the document was parsed with.
+        """
+        version, features, links, equations, blocks = document
+        if version != __version__:
+            raise ValueError('document parsed by PyTextile %s' % version)
+        mine = list(self.features)
+        mine.sort()
+        if features != mine:
+            raise ValueError('document parsed with features %s' % ', '.join(features))
 
-        text = '\n\n'.join(text)
+        self._links = links
+
+        # Convert all equations at once, if there's no cache to have
+        # them, see _render_blocks().
+        if itex2mml and cache is None:
+            _convert_itex(equations)
+
+        # Offset for the headers.
+        self.head_offset = head_offset
+
+        self.blocks = []
+        for handler, captures in blocks:
+            if 'header' in captures:
+                captures = captures.copy()
+                captures['header'] += head_offset
+            self.blocks.append((getattr(self, handler), captures))
+
+        return self._render_text(validate, sanitize, output, encoding, cache, jobs)
+
+
+    def _render_text(self, validate, sanitize, output, encoding, cache, jobs):
+        """Render self.blocks, for process() and render()."""
+        text = '\n\n'.join(self._render_blocks(self.blocks, encoding, output, cache, jobs))
+        self._flush_color_cache()
 
         # Add titles to footnotes.
-        text = self.footnotes(text)
+        if 'footnotes' in self.features:
+            text = self.footnotes(text)
 
         # Convert to desired output.
-        text = unicode(text, encoding)
-        text = text.encode(output, 'xmlcharrefreplace')
+        text = self.encode(text, encoding, output)
 
         # Sanitize?
         if sanitize:
             p = _HTMLSanitizer()
-            p.feed(text)
-            text = p.output()
+            text = p.process(text)
 
         # Validate output.
         if _tidy and validate:
@@ -863,6 +2536,263 @@ class Textiler:
         return text
 
 
+    def process_stream(self, fileobj, head_offset=HEAD_OFFSET, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, cache=None):
+        """Process text from a file object.
+
+        This works like process(), but reads the text from <fileobj>
+        and yields the HTML as each block is done, so only a block is
+        kept in memory instead of the whole text. Validation needs the
+        whole output, so it is not available here.
+
+        If <fileobj> can seek, it's read twice: first for the link
+        lookups, and then to process the blocks. Otherwise links can
+        only be used after they are defined.
+
+        References to footnotes defined further down are held back to
+        add the title, up to FOOTNOTE_WINDOW bytes of HTML.
+        """
+        self._links = {}
+        try:
+            start = fileobj.tell()
+        except (AttributeError, IOError):
+            start = None
+        if start is not None:
+            for text in self._read_text(fileobj, self._links):
+                pass
+            fileobj.seek(start)
+
+        # Offset for the headers.
+        self.head_offset = head_offset
+
+        def _texts():
+            for text in self._read_text(fileobj, self._links):
+                # Convert the equations of this piece at once.
+                if cache is None:
+                    self._prefetch_itex(text)
+                yield text
+
+        blocks = self._split_blocks(_texts())
+
+        if sanitize:
+            p = _HTMLSanitizer()
+
+        def _output(text):
+            # Convert to desired output.
+            text = self.encode(text, encoding, output)
+
+            # Sanitize?
+            if sanitize:
+                text = p.process(text)
+
+            return text
+
+        # Blocks are joined by an empty line.
+        separators = itertools.chain([''], itertools.repeat('\n\n'))
+
+        if 'footnotes' not in self.features:
+            for html in self._render_blocks(blocks, encoding, output, cache):
+                yield _output(separators.next() + html)
+            self._flush_color_cache()
+            return
+
+        notes = {}
+        held = []
+        size = 0
+        missing = {}
+        for html in self._render_blocks(blocks, encoding, output, cache):
+            self._find_footnotes(html, notes)
+            for n in missing.keys():
+                if notes.has_key(n):
+                    del missing[n]
+            for n in _footnote_reference.findall(html):
+                if not notes.has_key(n):
+                    missing[n] = 1
+
+            held.append(html)
+            size += len(html)
+            if missing and size <= FOOTNOTE_WINDOW:
+                continue
+
+            # Add titles to footnotes.
+            for html in held:
+                yield _output(separators.next() + self._title_footnotes(html, notes))
+            held = []
+            size = 0
+            missing = {}
+
+        for html in held:
+            yield _output(separators.next() + self._title_footnotes(html, notes))
+
+        self._flush_color_cache()
+
+
+    def encode(self, text, encoding, output):
+        """Convert the HTML from <encoding> to <output>.
+
+        Characters that <output> doesn't have become character
+        references.
+        """
+        return unicode(text, encoding).encode(output, 'xmlcharrefreplace')
+
+
+    def _flush_color_cache(self):
+        """Write the colorized code to the color cache, if any."""
+        if htmlizer and COLOR_CACHE is not None:
+            color_cache().flush()
+
+
+    def _prefetch_itex(self, text):
+        """Convert the equations in <text> with a single itex2mml run.
+
+        itex() then finds them already converted. Equations the
+        blocks end up not having are converted for nothing, and the
+        ones missed here are converted by itex() alone.
+        """
+        if itex2mml:
+            _convert_itex(self._equations(text))
+
+
+    def _equations(self, text):
+        """The equations in <text>, if the itex feature is on."""
+        if 'itex' not in self.features:
+            return []
+
+        equations = [m.group() for m in _itex_inline.finditer(text)]
+        equations.extend(_itex_block.findall(text))
+        return equations
+
+
+    def _render_blocks(self, blocks, encoding, output, cache=None, jobs=1):
+        """Render the blocks from split_text.
+
+        Yields the HTML of each block, getting it from <cache> (a
+        BlockCache, or a path for one) if possible, and rendering
+        the blocks in <jobs> processes if it's more than 1.
+        """
+        if isinstance(cache, basestring):
+            cache = BlockCache(cache)
+            try:
+                for html in self._render_blocks(blocks, encoding, output, cache, jobs):
+                    yield html
+            finally:
+                cache.close()
+            return
+
+        if jobs > 1 and multiprocessing is not None:
+            for html in self._render_parallel(list(blocks), encoding, output, cache, jobs):
+                yield html
+            return
+
+        if cache is None:
+            for [function, captures] in blocks:
+                yield function(**captures)
+            return
+
+        # The blocks are looked up a batch at a time, so the equations
+        # of the ones missing can be converted at once. Each one keeps
+        # the links it would have been rendered with, as reading ahead
+        # may add links when streaming.
+        links = None
+        batch = []
+        size = 0
+        for [function, captures] in blocks:
+            if links != self._links:
+                links = self._links.copy()
+                options = self._cache_options(encoding, output)
+
+            batch.append((function, captures, _block_key(function, captures, options), links))
+            size += len(captures.get('text') or '')
+            if size >= _READ_SIZE:
+                for html in self._render_batch(batch, cache):
+                    yield html
+                batch = []
+                size = 0
+
+        for html in self._render_batch(batch, cache):
+            yield html
+
+        cache.flush()
+
+
+    def _render_batch(self, batch, cache):
+        """Render a batch of blocks from _render_blocks().
+
+        <batch> has the (function, captures, key, links) of each
+        block. Returns the list of HTML of the blocks, in order.
+        """
+        html = [cache.get(key) for function, captures, key, links in batch]
+        self._prefetch_itex('\n\n'.join([batch[i][1].get('text') or '' for i in range(len(batch)) if html[i] is None]))
+
+        live = self._links
+        try:
+            for i, (function, captures, key, links) in enumerate(batch):
+                if html[i] is None:
+                    self._links = links
+                    html[i] = function(**captures)
+                    cache.put(key, html[i])
+        finally:
+            self._links = live
+
+        return html
+
+
+    def _render_parallel(self, blocks, encoding, output, cache, jobs):
+        """Render the blocks in a pool of <jobs> processes.
+
+        Returns the list of HTML of the blocks, in order.
+        """
+        # All the captures are needed to send them.
+        blocks = [tuple(block) for block in blocks]
+
+        html = [None] * len(blocks)
+        if cache is not None:
+            options = self._cache_options(encoding, output)
+            keys = [_block_key(function, captures, options) for function, captures in blocks]
+            html = [cache.get(key) for key in keys]
+
+        # Send the blocks that are not cached in ordered chunks, two
+        # per process: more balance the work better, but each one is
+        # sent and returned on its own. The processes get the
+        # equations already converted.
+        todo = [i for i in range(len(blocks)) if html[i] is None]
+        if cache is not None:
+            self._prefetch_itex('\n\n'.join([blocks[i][1].get('text') or '' for i in todo]))
+        size = max(1, (len(todo) + jobs * 2 - 1) / (jobs * 2))
+        chunks = []
+        for start in range(0, len(todo), size):
+            chunks.append([(blocks[i][0].__name__, blocks[i][1]) for i in todo[start:start+size]])
+
+        rendered = []
+        if chunks:
+            shared = (self.__class__, self.features, self._links, self.head_offset)
+            for chunk in _map_chunks(jobs, chunks, shared):
+                rendered.extend(chunk)
+
+        for i, block in zip(todo, rendered):
+            html[i] = block
+            if cache is not None:
+                cache.put(keys[i], block)
+
+        if cache is not None:
+            cache.flush()
+
+        return html
+
+
+    def _cache_options(self, encoding, output):
+        """Everything besides a block that changes its output."""
+        links = self._links.items()
+        links.sort()
+
+        features = list(self.features)
+        features.sort()
+
+        searches = self.searches.items()
+        searches.sort()
+
+        return (__version__, _CACHE_FORMAT, self.__class__.__name__, features, itex2mml, bool(htmlizer), searches, self.head_offset, encoding, output, links)
+
+
     def sanitize(self, text):
         """Fix single tags.
 
@@ -881,10 +2811,10 @@ class Textiler:
         to ensure 100% valid XHTML(eXtensible HyperText Markup Language).
         """
         # Fix single tags like <img /> and <br />.
-        text = preg_replace(r'''<(img|br|hr)(.*?)(?:\s*/?\s*)?>''', r'''<\1\2 />''', text)
+        text = _single_tag.sub(r'''<\1\2 />''', text)
 
         # Remove ampersands.
-        text = preg_replace(r'''&(?!#?[xX]?(?:[0-9a-fA-F]+|\w{1,8});)''', r'''&amp;''', text)
+        text = _bare_ampersand.sub(r'''&amp;''', text)
 
         return text
 
@@ -946,73 +2876,95 @@ class Textiler:
 
         pre. <p lang="en" style="color:red;padding-left:2em;padding-right:2em;float:right;" class="class right" id="id">A simple paragraph.</p>
         """
-        # Clear signature.
-        clear_sig = r'''^clear(?P<alignment>[<>])?\.$'''
+        return list(self._split_blocks([self.text]))
+
+
+    def _split_blocks(self, texts):
+        """Associate the blocks with the functions to process them.
+
+        This does the work of split_text, on each of <texts> in turn,
+        and a block can be extended from one to the next. A _Block is
+        yielded for each block as soon as it's complete.
+
+        The blocks are matched where they are in the text, and
+        nothing is copied out of it but the text added to extended
+        blocks, which is joined once, when the block is complete.
+        """
         clear = None
 
         extending  = 0
 
-        # We capture the \n's because they are important inside "pre..".
-        blocks = re.split(r'''((\n\s*){2,})''', self.text)
-        output = []
-        for block in blocks:
-            # Check for the clear signature.
-            m = re.match(clear_sig, block)
-            if m:
-                clear = m.group('alignment')
-                if clear:
-                    clear = {'<': 'clear:left;', '>': 'clear:right;'}[clear]
-                else:
-                    clear = 'clear:both;'
+        last = None
+        more = []
+        for text in texts:
+            for start, end, kind in _block_spans(text):
+                if kind == 'separator':
+                    # Only extended blocks keep the separators.
+                    if extending:
+                        more.append(text[start:end])
+                    continue
 
-            else:
-                # Check each of the code signatures.
-                for regexp, function in self.signatures:
-                    p = re.compile(regexp, (re.VERBOSE | re.DOTALL))
-                    m = p.match(block)
+                # Check for the clear signature.
+                m = _clear_signature.match(text, start, end)
+                if m:
+                    clear = m.group('alignment')
+                    if clear:
+                        clear = {'<': 'clear:left;', '>': 'clear:right;'}[clear]
+                    else:
+                        clear = 'clear:both;'
+                    continue
+
+                # Check the code signatures that can match this block.
+                for p, handler in self._dispatcher.get(text[start], ()):
+                    m = p.match(text, start, end)
                     if m:
-                        # Put everything in a dictionary.
-                        captures = m.groupdict()
+                        groups = p.groupindex
 
                         # If we are extending a block, we require a dot to
                         # break it, so we can start lines with '#' inside
                         # an extended <pre> without matching an ordered list.
-                        if extending and not captures.get('dot', None):
-                            output[-1][1]['text'] += block
+                        if extending and not ('dot' in groups and m.group('dot')):
+                            more.append(text[start:end])
                             break 
-                        elif captures.has_key('dot'):
-                            del captures['dot']
                             
                         # If a signature matches, we are not extending a block.
                         extending = 0
 
                         # Check if we should extend this block.
-                        if captures.has_key('extend'):
-                            extending = captures['extend']
-                            del captures['extend']
+                        if 'extend' in groups:
+                            extending = m.group('extend')
                             
                         # Apply head_offset.
-                        if captures.has_key('header'):
-                            captures['header'] = int(captures['header']) + self.head_offset
+                        changes = None
+                        if 'header' in groups:
+                            changes = {'header': int(m.group('header')) + self.head_offset}
 
                         # Apply clear.
                         if clear:
-                            captures['clear'] = clear
+                            changes = changes or {}
+                            changes['clear'] = clear
                             clear = None
 
-                        # Save the block to be processed later.
-                        output.append([function, captures])
+                        # The previous block is complete.
+                        if last is not None:
+                            yield last.extend(more)
+                        last = _Block(getattr(self, handler), m, text, start, end, changes)
+                        more = []
 
                         break
 
                 else:
                     if extending:
                         # Append the text to the last block.
-                        output[-1][1]['text'] += block
-                    elif block.strip():
-                        output.append([self.paragraph, {'text': block}])
-    
-        return output
+                        more.append(text[start:end])
+                    elif text[start:end].strip():
+                        if last is not None:
+                            yield last.extend(more)
+                        last = _Block(self.paragraph, None, text, start, end)
+                        more = []
+
+        if last is not None:
+            yield last.extend(more)
 
 
     def parse_params(self, parameters, clear=None, align_type='block'):
@@ -1039,6 +2991,10 @@ class Textiler:
                       'style': 'color:red;text-align:right;'}
 
         Note that order is not important.
+
+        The same parameters are used over and over (think of the cells
+        of a table), so the results are remembered. Each call returns a
+        new dictionary, which the caller can change.
         """
         if not parameters:
             if clear:
@@ -1046,22 +3002,42 @@ class Textiler:
             else:
                 return {}
 
-        output = {}
+        key = (parameters, clear, align_type)
+        try:
+            items = self._params_memo[key]
+        except KeyError:
+            items = self._parse_params(parameters, clear, align_type)
+            if len(self._params_memo) >= _MEMO_SIZE:
+                self._params_memo.clear()
+            self._params_memo[key] = items
+
+        # The attributes are added in the order they were found, so
+        # they come out of build_open_tag() in the same order.
+        return dict(items)
+
+
+    def _parse_params(self, parameters, clear, align_type):
+        """Parse the parameters from a block signature.
+
+        This does the work of parse_params(), returning a tuple of
+        (attribute, value) in the order the attributes were found.
+        """
+        output = OrderedDict()
         
         # Match class from (class) or (class#id).
-        m = re.search(r'''\((?P<class>[\w]+(\s[\w]+)*)(\#[\w][\w\d\.:_-]*)?\)''', parameters)
+        m = _param_class.search(parameters)
         if m: output['class'] = m.group('class')
 
         # Match id from (#id) or (class#id).
-        m = re.search(r'''\([\w]*(\s[\w]+)*\#(?P<id>[\w][\w\d\.:_-]*)\)''', parameters)
+        m = _param_id.search(parameters)
         if m: output['id'] = m.group('id')
 
         # Match [language].
-        m = re.search(r'''\[(?P<lang>[\w-]+)\]''', parameters)
+        m = _param_lang.search(parameters)
         if m: output['lang'] = m.group('lang')
 
         # Match {style}.
-        m = re.search(r'''{(?P<style>[^\}]+)}''', parameters)
+        m = _param_style.search(parameters)
         if m:
             output['style'] = m.group('style').replace('\n', '')
 
@@ -1075,9 +3051,9 @@ class Textiler:
 
         # Remove classes, ids, langs and styles. This makes the 
         # regular expression for the positioning much easier.
-        parameters = preg_replace(r'''\([\#\w\d\.:_\s-]+\)''', '', parameters)
-        parameters = preg_replace(r'''\[[\w-]+\]''', '', parameters)
-        parameters = preg_replace(r'''{[\w:;#%-]+}''', '', parameters)
+        parameters = _param_classid_remove.sub('', parameters)
+        parameters = _param_lang_remove.sub('', parameters)
+        parameters = _param_style_remove.sub('', parameters)
 
         style = []
         
@@ -1128,12 +3104,12 @@ class Textiler:
                     output['valign'] = _style
 
             # Colspan and rowspan.
-            m = re.search(r'''\\(\d+)''', parameters)
+            m = _param_colspan.search(parameters)
             if m:
                 #output['colspan'] = m.groups()
                 output['colspan'] = int(m.groups()[0])
 
-            m = re.search(r'''/(\d+)''', parameters)
+            m = _param_rowspan.search(parameters)
             if m:
                 output['rowspan'] = int(m.groups()[0])
 
@@ -1164,7 +3140,7 @@ class Textiler:
         if output.has_key('class'):
             output['class'] = output['class'].strip()
 
-        return output 
+        return tuple(output.items())
         
 
     def build_open_tag(self, tag, attributes={}, single=0):
@@ -1174,9 +3150,16 @@ class Textiler:
         generate the opening tags with the attributes of
         the block.
         """
+        items = attributes.items()
+        key = (tag, tuple(items), single)
+        try:
+            return self._open_tag_memo[key]
+        except KeyError:
+            pass
+
         # Open tag.
         open_tag = ['<%s' % tag]
-        for k,v in attributes.items():
+        for k,v in items:
             # The ALT attribute can be empty.
             if k == 'alt' or v: open_tag.append(' %s="%s"' % (k, v))
 
@@ -1186,7 +3169,12 @@ class Textiler:
         # Close tag.
         open_tag.append('>')
 
-        return ''.join(open_tag)
+        open_tag = ''.join(open_tag)
+        if len(self._open_tag_memo) >= _MEMO_SIZE:
+            self._open_tag_memo.clear()
+        self._open_tag_memo[key] = open_tag
+
+        return open_tag
 
 
     def paragraph(self, text, parameters=None, attributes=None, clear=None):
@@ -1235,11 +3223,28 @@ class Textiler:
                 # Pop the id because it must be unique.
                 if attributes.has_key('id'): del attributes['id']
 
+                if not _markup.search(line):
+                    # Plain prose, only the glyphs change it. The text
+                    # was split at blank lines, so each line break is
+                    # one <br />, and the glyphs are replaced between
+                    # them as glyphs() would do.
+                    if STATS:
+                        _paragraph_counts[0] += 1
+                    parts = line.split('\n')
+                    glyphs = [self._glyphs_and_links(parts[0])]
+                    for part in parts[1:]:
+                        glyphs.append(self._glyphs_and_links('\n' + part))
+                    output.append(open_tag + '<br />'.join(glyphs) + close_tag)
+                    continue
+
+                if STATS:
+                    _paragraph_counts[1] += 1
+
                 # Break lines. 
                 line = preg_replace(r'(<br />|\n)+', '<br />\n', line)
 
                 # Remove <br /> from inside broken HTML tags.
-                line = preg_replace(r'(<[^>]*)<br />\n(.*?>)', r'\1 \2', line)
+                line = _join_broken_tags(line)
 
                 # Inline formatting.
                 line = self.inline(line)
@@ -1349,7 +3354,7 @@ class Textiler:
 
         # Colorize Python code?
         if htmlizer and lang == 'python':
-            text = _color(text)
+            text = _cached_color(text, lang)
         else:
             # Replace < and >.
             text = text.replace('<', '&lt;')
@@ -1579,99 +3584,110 @@ class Textiler:
         works by peeking at the next list item, and searching for a
         multi-list. If a multi-list is found, it is processed and 
         appended inside the list item tags, as it should be.
+
+        The items are walked by index, and the multi-lists are kept
+        in a stack instead of calling ol() and ul() recursively, so
+        long lists and deep lists take linear time.
         """
-        lines = []
-        while len(items):
-            item = items.pop(0)
+        # Each level of the stack is a list being built: its tags,
+        # its items, the index of the next one, the items already
+        # built and the item waiting for its multi-list.
+        stack = [{'open': '', 'close': '', 'items': items, 'next': 0,
+                  'lines': [], 'liattributes': liattributes, 'waiting': None}]
+        while True:
+            level = stack[-1]
+            items = level['items']
+            i = level['next']
+
+            # The list is done, put it in the item waiting for it.
+            if i == len(items):
+                text = level['open'] + '\n'.join(level['lines']) + level['close']
+                stack.pop()
+                if not stack:
+                    return text
+
+                level = stack[-1]
+                open_tag_li, item = level['waiting']
+                level['waiting'] = None
+                item = item + '\n' + text + '\n'
+                level['lines'].append(open_tag_li + self.inline(item) + '</li>')
+                continue
+
+            item = items[i]
+            i += 1
 
             # Clean the line.
             item = item.lstrip()
             item = item.replace('\n', '<br />\n')
 
             # Get list item attributes.
-            p = re.compile(r'''^%(liattr)s\s''' % self.res, re.VERBOSE)
-            m = p.match(item)
+            m = _li_attributes.match(item)
             if m:
-                c = m.groupdict('')
-                liparameters = c['liparameters']
-                item = p.sub('', item)
+                liparameters = m.group('liparameters') or ''
+                item = item[m.end():]
             else:
                 liparameters = ''
 
-            liattributes = liattributes or self.parse_params(liparameters)
+            liattributes = level['liattributes'] or self.parse_params(liparameters)
             
             # Build the item tag.
             open_tag_li = self.build_open_tag('li', liattributes) 
 
             # Reset the attributes, which should be applied
             # only to the first <li>.
-            liattributes = {}
-
-            # Build the closing tag.
-            close_tag_li = '</li>'
+            level['liattributes'] = {}
 
-            # Multi-list recursive routine.
+            # Multi-list routine.
             # Here we check the _next_ items for a multi-list. If we
-            # find one, we extract all items of the multi-list and
-            # process them recursively.
-            if len(items):
-                inlist = []
-
-                # Grab all the items that start with # or *.
-                n_item = items.pop(0)
-
+            # find one, we start a new level with all its items, and
+            # come back to this item when it's done.
+            if i < len(items):
                 # Grab the <ol> parameters.
-                p = re.compile(r'''^%(olattr)s''' % self.res, re.VERBOSE)
-                m = p.match(n_item)
-                if m:
-                    c = m.groupdict('')
-                    olparameters = c['olparameters']
-                    tmp = p.sub('', n_item)
-                else:
-                    olparameters = ''
-
-                # Check for an ordered list inside this one.
-                if tmp.startswith('#'):
-                    n_item = tmp
-                    inlist.append(n_item)
-                    while len(items):
-                        # Peek into the next item.
-                        n_item = items.pop(0)
-                        if n_item.startswith('#'):
-                            inlist.append(n_item)
-                        else:
-                            items.insert(0, n_item)
-                            break
-                        
-                    inlist = self.ol('\n'.join(inlist), olparameters=olparameters)
-                    item = item + '\n' + inlist + '\n'
-
-                # Check for an unordered list inside this one.
-                elif tmp.startswith('*'):
-                    n_item = tmp
-                    inlist.append(n_item)
-                    while len(items):
-                        # Peek into the next item.
-                        n_item = items.pop(0)
-                        if n_item.startswith('*'):
-                            inlist.append(n_item)
-                        else:
-                            items.insert(0, n_item)
-                            break
-
-                    inlist = self.ul('\n'.join(inlist), olparameters=olparameters)
-                    item = item + '\n' + inlist + '\n'
-
-                # Otherwise we just put it back in the list.
-                else:
-                    items.insert(0, n_item)
-
-            item = self.inline(item)
+                n_item = items[i]
+                m = _ol_attributes.match(n_item)
+                olparameters = m.group('olparameters') or ''
+                tmp = n_item[m.end():]
+
+                # Check for an (un)ordered list inside this one, and
+                # grab all the items that start with the same # or *.
+                if tmp.startswith('#') or tmp.startswith('*'):
+                    bullet = tmp[0]
+                    j = i + 1
+                    while j < len(items) and items[j].startswith(bullet):
+                        j += 1
+
+                    inlist = [tmp]
+                    inlist.extend(items[i+1:j])
+                    level['next'] = j
+                    level['waiting'] = (open_tag_li, item)
+                    stack.append(self._list_level(bullet, '\n'.join(inlist), olparameters))
+                    continue
+
+            level['next'] = i
+            level['lines'].append(open_tag_li + self.inline(item) + '</li>')
+
+
+    def _list_level(self, bullet, text, olparameters):
+        """Start a multi-list for build_li().
+
+        Does what ol() or ul() would do with the text of the list,
+        but returns a new level for the stack of build_li().
+        """
+        if bullet == '#':
+            tag = 'ol'
+        else:
+            tag = 'ul'
 
-            item = open_tag_li + item + close_tag_li
-            lines.append(item)
+        # Remove list depth.
+        text = text[1:]
 
-        return '\n'.join(lines)
+        return {'open': self.build_open_tag(tag, self.parse_params(olparameters)) + '\n',
+                'close': '\n</%s>' % tag,
+                'items': text.split('\n' + bullet),
+                'next': 0,
+                'lines': [],
+                'liattributes': {},
+                'waiting': None}
 
 
     def ol(self, text, liparameters=None, olparameters=None, clear=None):
@@ -1906,10 +3922,12 @@ class Textiler:
         open_tag = self.build_open_tag('table', attributes) + '\n'
         close_tag = '</table>'
 
-        output = []
-        default_align = {}
-        rows = re.split(r'''\n+''', text)
-        for row in rows:
+        output = [open_tag]
+
+        # The default alignment of each column, set by the headers.
+        default_align = []
+
+        for row in _table_rows.split(text):
             # Get the columns.
             columns = row.split('|')
 
@@ -1928,44 +3946,52 @@ class Textiler:
                 
             col = 0
             for cell in columns[:-1]:
-                p = re.compile(r'''(?:%(tattr)s\.\s)?(?P<text>.*)''' % self.res, re.VERBOSE)
-                m = p.match(cell)
-                if m:
-                    c = m.groupdict('')
-                    cellattr = self.parse_params(c['parameters'], align_type='table')
-
-                    # Get the width of this cell.
-                    width = cellattr.get('colspan', 1)
-
-                    # Is this a header?
-                    if c['parameters'].count('_'):
-                        td_tag = 'th'
-
-                    # If it is a header, let's set the default alignment.
-                    if td_tag == 'th':
-                        # Set the default aligment for all cells below this one.
-                        # This is a little tricky because this header can have
-                        # a colspan set.
-                        for i in range(col, col+width):
-                            default_align[i] = cellattr.get('align', None)
+                if '.' not in cell or not _cell_period.search(cell):
+                    # A plain cell, parameters end with a period.
+                    cellparameters = ''
+                    cellattr = {}
+                    celltext = cell
+                else:
+                    m = _cell.match(cell)
+                    cellparameters = m.group('parameters') or ''
+                    cellattr = self.parse_params(cellparameters, align_type='table')
+                    celltext = m.group('text')
+
+                # Get the width of this cell.
+                width = cellattr.get('colspan', 1)
+
+                # Is this a header?
+                if cellparameters.count('_'):
+                    td_tag = 'th'
+
+                # If it is a header, let's set the default alignment.
+                if td_tag == 'th':
+                    # Set the default aligment for all cells below this one.
+                    # This is a little tricky because this header can have
+                    # a colspan set.
+                    if len(default_align) < col + width:
+                        default_align.extend([None] * (col + width - len(default_align)))
+                    default_align[col:col+width] = [cellattr.get('align', None)] * width
 
+                else:
+                    # Apply the default align, if any.
+                    if col < len(default_align):
+                        align = default_align[col]
                     else:
-                        # Apply the default align, if any.
-                        cellattr['align'] = cellattr.get('align', default_align.get(col, None))
+                        align = None
+                    cellattr['align'] = cellattr.get('align', align)
 
-                    open_td = self.build_open_tag(td_tag, cellattr)
-                    close_td = '</%s>\n' % td_tag
-
-                    #output.append(open_td + c['text'].strip() + close_td)
-                    output.append(open_td + self.inline(c['text'].strip()) + close_td)
+                output.append(self.build_open_tag(td_tag, cellattr))
+                output.append(self.inline(celltext.strip()))
+                output.append('</%s>\n' % td_tag)
 
                 col += width
 
             output.append('</tr>\n')
 
-        text = open_tag + ''.join(output) + close_tag
+        output.append(close_tag)
 
-        return text
+        return ''.join(output)
 
 
     def escape(self, text):
@@ -2030,10 +4056,7 @@ class Textiler:
         accepted by all browsers.)
         """
         if itex2mml:
-            try:
-                text = os.popen("echo '%s' | %s" % (text, itex2mml)).read()
-            except:
-                pass
+            text = _convert_itex([text]).get(text, text)
 
         return text
 
@@ -2127,17 +4150,20 @@ class Textiler:
 
         are all valid acronyms.
         """
-        # Find the acronyms.
-        acronyms = r'''(?P<acronym>[\w]+)\((?P<definition>[^\(\)]+?)\)'''
-
         # Check all acronyms.
-        for acronym, definition in re.findall(acronyms, text):
-            caps_acronym = ''.join(re.findall('[A-Z\d]+', acronym))
-            caps_definition = ''.join(re.findall('[A-Z\d]+', definition))
+        def _replace(m):
+            acronym, definition = m.groups()
+            caps_acronym = ''.join(_acronym_caps.findall(acronym))
+            caps_definition = ''.join(_acronym_caps.findall(definition))
             if caps_acronym and caps_acronym == caps_definition:
-                text = text.replace('%s(%s)' % (acronym, definition), '<acronym title="%s">%s</acronym>' % (definition, acronym))
-        
-        text = html_replace(r'''(^|\s)([A-Z]{3,})\b(?!\()''', r'''\1<span class="caps">\2</span>''', text)
+                return '<acronym title="%s">%s</acronym>' % (definition, acronym)
+            return m.group()
+
+        if '(' in text:
+            text = _acronym.sub(_replace, text)
+
+        if 'caps' in self.features:
+            text = html_replace(r'''(^|\s)([A-Z]{3,})\b(?!\()''', r'''\1<span class="caps">\2</span>''', text)
 
         return text
 
@@ -2149,17 +4175,33 @@ class Textiler:
         adds a title to the link containing the first paragraph of the
         footnote.
         """
-        # Search for footnotes.
-        p = re.compile(r'''<p class="footnote" id="fn(?P<n>\d+)"><sup>(?P=n)</sup>(?P<note>.*)</p>''')
-        for m in p.finditer(text):
+        notes = {}
+        self._find_footnotes(text, notes)
+
+        return self._title_footnotes(text, notes)
+
+
+    def _find_footnotes(self, text, notes):
+        """Store the first paragraph of the footnotes in <notes>."""
+        # Search for footnotes. If a footnote is defined twice, the
+        # first definition gives the title.
+        for m in _footnote_paragraph.finditer(text):
             n = m.group('n')
-            note = m.group('note').strip()
+            if not notes.has_key(n):
+                # Strip HTML from note.
+                notes[n] = ''.join(_split_tags(m.group('note').strip())[::2])
+
 
-            # Strip HTML from note.
-            note = re.sub('<.*?>', '', note)
+    def _title_footnotes(self, text, notes):
+        """Add the titles from <notes> to footnotes references."""
+        def _replace(m):
+            n = m.group('n')
+            if notes.has_key(n):
+                return '<a href="#fn%s" title="%s">' % (n, notes[n])
+            return m.group()
 
-            # Add the title.
-            text = text.replace('<a href="#fn%s">' % n, '<a href="#fn%s" title="%s">' % (n, note))
+        if notes:
+            text = _footnote_reference.sub(_replace, text)
 
         return text
 
@@ -2195,176 +4237,12 @@ class Textiler:
         """
         entity = m.group(1)
 
-        macros = {'c|': '&#162;',       # cent sign
-                  '|c': '&#162;',       # cent sign
-                  'L-': '&#163;',       # pound sign
-                  '-L': '&#163;',       # pound sign
-                  'Y=': '&#165;',       # yen sign
-                  '=Y': '&#165;',       # yen sign
-                  '(c)': '&#169;',      # copyright sign
-                  '<<': '&#171;',       # left-pointing double angle quotation
-                  '(r)': '&#174;',      # registered sign
-                  '+_': '&#177;',       # plus-minus sign
-                  '_+': '&#177;',       # plus-minus sign
-                  '>>': '&#187;',       # right-pointing double angle quotation
-                  '1/4': '&#188;',      # vulgar fraction one quarter
-                  '1/2': '&#189;',      # vulgar fraction one half
-                  '3/4': '&#190;',      # vulgar fraction three quarters
-                  'A`': '&#192;',       # latin capital letter a with grave
-                  '`A': '&#192;',       # latin capital letter a with grave
-                  'A\'': '&#193;',      # latin capital letter a with acute
-                  '\'A': '&#193;',      # latin capital letter a with acute
-                  'A^': '&#194;',       # latin capital letter a with circumflex
-                  '^A': '&#194;',       # latin capital letter a with circumflex
-                  'A~': '&#195;',       # latin capital letter a with tilde
-                  '~A': '&#195;',       # latin capital letter a with tilde
-                  'A"': '&#196;',       # latin capital letter a with diaeresis
-                  '"A': '&#196;',       # latin capital letter a with diaeresis
-                  'Ao': '&#197;',       # latin capital letter a with ring above
-                  'oA': '&#197;',       # latin capital letter a with ring above
-                  'AE': '&#198;',       # latin capital letter ae
-                  'C,': '&#199;',       # latin capital letter c with cedilla
-                  ',C': '&#199;',       # latin capital letter c with cedilla
-                  'E`': '&#200;',       # latin capital letter e with grave
-                  '`E': '&#200;',       # latin capital letter e with grave
-                  'E\'': '&#201;',      # latin capital letter e with acute
-                  '\'E': '&#201;',      # latin capital letter e with acute
-                  'E^': '&#202;',       # latin capital letter e with circumflex
-                  '^E': '&#202;',       # latin capital letter e with circumflex
-                  'E"': '&#203;',       # latin capital letter e with diaeresis
-                  '"E': '&#203;',       # latin capital letter e with diaeresis
-                  'I`': '&#204;',       # latin capital letter i with grave
-                  '`I': '&#204;',       # latin capital letter i with grave
-                  'I\'': '&#205;',      # latin capital letter i with acute
-                  '\'I': '&#205;',      # latin capital letter i with acute
-                  'I^': '&#206;',       # latin capital letter i with circumflex
-                  '^I': '&#206;',       # latin capital letter i with circumflex
-                  'I"': '&#207;',       # latin capital letter i with diaeresis
-                  '"I': '&#207;',       # latin capital letter i with diaeresis
-                  'D-': '&#208;',       # latin capital letter eth
-                  '-D': '&#208;',       # latin capital letter eth
-                  'N~': '&#209;',       # latin capital letter n with tilde
-                  '~N': '&#209;',       # latin capital letter n with tilde
-                  'O`': '&#210;',       # latin capital letter o with grave
-                  '`O': '&#210;',       # latin capital letter o with grave
-                  'O\'': '&#211;',      # latin capital letter o with acute
-                  '\'O': '&#211;',      # latin capital letter o with acute
-                  'O^': '&#212;',       # latin capital letter o with circumflex
-                  '^O': '&#212;',       # latin capital letter o with circumflex
-                  'O~': '&#213;',       # latin capital letter o with tilde
-                  '~O': '&#213;',       # latin capital letter o with tilde
-                  'O"': '&#214;',       # latin capital letter o with diaeresis
-                  '"O': '&#214;',       # latin capital letter o with diaeresis
-                  'O/': '&#216;',       # latin capital letter o with stroke
-                  '/O': '&#216;',       # latin capital letter o with stroke
-                  'U`':  '&#217;',      # latin capital letter u with grave
-                  '`U':  '&#217;',      # latin capital letter u with grave
-                  'U\'': '&#218;',      # latin capital letter u with acute
-                  '\'U': '&#218;',      # latin capital letter u with acute
-                  'U^': '&#219;',       # latin capital letter u with circumflex
-                  '^U': '&#219;',       # latin capital letter u with circumflex
-                  'U"': '&#220;',       # latin capital letter u with diaeresis
-                  '"U': '&#220;',       # latin capital letter u with diaeresis
-                  'Y\'': '&#221;',      # latin capital letter y with acute
-                  '\'Y': '&#221;',      # latin capital letter y with acute
-                  'a`': '&#224;',       # latin small letter a with grave
-                  '`a': '&#224;',       # latin small letter a with grave
-                  'a\'': '&#225;',      # latin small letter a with acute
-                  '\'a': '&#225;',      # latin small letter a with acute
-                  'a^': '&#226;',       # latin small letter a with circumflex
-                  '^a': '&#226;',       # latin small letter a with circumflex
-                  'a~': '&#227;',       # latin small letter a with tilde
-                  '~a': '&#227;',       # latin small letter a with tilde
-                  'a"': '&#228;',       # latin small letter a with diaeresis
-                  '"a': '&#228;',       # latin small letter a with diaeresis
-                  'ao': '&#229;',       # latin small letter a with ring above
-                  'oa': '&#229;',       # latin small letter a with ring above
-                  'ae': '&#230;',       # latin small letter ae
-                  'c,': '&#231;',       # latin small letter c with cedilla
-                  ',c': '&#231;',       # latin small letter c with cedilla
-                  'e`': '&#232;',       # latin small letter e with grave
-                  '`e': '&#232;',       # latin small letter e with grave
-                  'e\'': '&#233;',      # latin small letter e with acute
-                  '\'e': '&#233;',      # latin small letter e with acute
-                  'e^': '&#234;',       # latin small letter e with circumflex
-                  '^e': '&#234;',       # latin small letter e with circumflex
-                  'e"': '&#235;',       # latin small letter e with diaeresis
-                  '"e': '&#235;',       # latin small letter e with diaeresis
-                  'i`': '&#236;',       # latin small letter i with grave
-                  '`i': '&#236;',       # latin small letter i with grave
-                  'i\'': '&#237;',      # latin small letter i with acute
-                  '\'i': '&#237;',      # latin small letter i with acute
-                  'i^': '&#238;',       # latin small letter i with circumflex
-                  '^i': '&#238;',       # latin small letter i with circumflex
-                  'i"': '&#239;',       # latin small letter i with diaeresis
-                  '"i': '&#239;',       # latin small letter i with diaeresis
-                  'n~': '&#241;',       # latin small letter n with tilde
-                  '~n': '&#241;',       # latin small letter n with tilde
-                  'o`': '&#242;',       # latin small letter o with grave
-                  '`o': '&#242;',       # latin small letter o with grave
-                  'o\'': '&#243;',      # latin small letter o with acute
-                  '\'o': '&#243;',      # latin small letter o with acute
-                  'o^': '&#244;',       # latin small letter o with circumflex
-                  '^o': '&#244;',       # latin small letter o with circumflex
-                  'o~': '&#245;',       # latin small letter o with tilde
-                  '~o': '&#245;',       # latin small letter o with tilde
-                  'o"': '&#246;',       # latin small letter o with diaeresis
-                  '"o': '&#246;',       # latin small letter o with diaeresis
-                  ':-': '&#247;',       # division sign
-                  '-:': '&#247;',       # division sign
-                  'o/': '&#248;',       # latin small letter o with stroke
-                  '/o': '&#248;',       # latin small letter o with stroke
-                  'u`': '&#249;',       # latin small letter u with grave
-                  '`u': '&#249;',       # latin small letter u with grave
-                  'u\'': '&#250;',      # latin small letter u with acute
-                  '\'u': '&#250;',      # latin small letter u with acute
-                  'u^': '&#251;',       # latin small letter u with circumflex
-                  '^u': '&#251;',       # latin small letter u with circumflex
-                  'u"': '&#252;',       # latin small letter u with diaeresis
-                  '"u': '&#252;',       # latin small letter u with diaeresis
-                  'y\'': '&#253;',      # latin small letter y with acute
-                  '\'y': '&#253;',      # latin small letter y with acute
-                  'y"': '&#255',        # latin small letter y with diaeresis
-                  '"y': '&#255',        # latin small letter y with diaeresis
-                  'OE': '&#338;',       # latin capital ligature oe
-                  'oe': '&#339;',       # latin small ligature oe
-                  '*': '&#8226;',       # bullet
-                  'Fr': '&#8355;',      # french franc sign
-                  'L=': '&#8356;',      # lira sign
-                  '=L': '&#8356;',      # lira sign
-                  'Rs': '&#8360;',      # rupee sign
-                  'C=': '&#8364;',      # euro sign
-                  '=C': '&#8364;',      # euro sign
-                  'tm': '&#8482;',      # trade mark sign
-                  '<-': '&#8592;',      # leftwards arrow
-                  '->': '&#8594;',      # rightwards arrow
-                  '<=': '&#8656;',      # leftwards double arrow
-                  '=>': '&#8658;',      # rightwards double arrow
-                  '=/': '&#8800;',      # not equal to
-                  '/=': '&#8800;',      # not equal to
-                  '<_': '&#8804;',      # less-than or equal to
-                  '_<': '&#8804;',      # less-than or equal to
-                  '>_': '&#8805;',      # greater-than or equal to
-                  '_>': '&#8805;',      # greater-than or equal to
-                  ':(': '&#9785;',      # white frowning face
-                  ':)': '&#9786;',      # white smiling face
-                  'spade': '&#9824;',   # black spade suit
-                  'club': '&#9827;',    # black club suit
-                  'heart': '&#9829;',   # black heart suit
-                  'diamond': '&#9830;', # black diamond suit
-                 }
-
         try:
             # Try the key.
-            entity = macros[entity]
+            entity = _macros[entity]
         except KeyError:
-            try:
-                # Try a unicode entity.
-                entity = unicodedata.lookup(entity)
-                entity = entity.encode('ascii', 'xmlcharrefreplace')
-            except:
-                # Return the unmodified entity.
-                entity = '{%s}' % entity
+            # Try a unicode entity, or return the unmodified entity.
+            entity = _unicode_entity(entity) or '{%s}' % entity
 
         return entity
 
@@ -2391,86 +4269,76 @@ class Textiler:
         * Convert ==(TM)==, ==(R)==, and  ==(C)== to &#8482;, &#174;, and &#169;.
         * Convert the letter x to a dimension sign: 2==x==4 to 2x4 and 8 ==x== 10 to 8x10.
         """
-        glyphs = [(r'''"(?<!\w)\b''', r'''&#8220;'''),                              # double quotes
-                  (r'''"''', r'''&#8221;'''),                                       # double quotes
-                  (r"""\b'""", r'''&#8217;'''),                                     # single quotes
-                  (r"""'(?<!\w)\b""", r'''&#8216;'''),                              # single quotes
-                  (r"""'""", r'''&#8217;'''),                                       # single single quote
-                  (r'''(\b|^)( )?\.{3}''', r'''\1&#8230;'''),                       # ellipsis
-                  (r'''\b---\b''', r'''&#8212;&#8212;'''),                          # double em dash
-                  (r'''\s?--\s?''', r'''&#8212;'''),                                # em dash
-                  (r'''(\d+)-(\d+)''', r'''\1&#8211;\2'''),                         # en dash (1954-1999)
-                  (r'''(\d+)-(\W)''', r'''\1&#8212;\2'''),                          # em dash (1954--)
-                  (r'''\s-\s''', r''' &#8211; '''),                                 # en dash
-                  (r'''(\d+) ?x ?(\d+)''', r'''\1&#215;\2'''),                      # dimension sign
-                  (r'''\b ?(\((tm|TM)\))''', r'''&#8482;'''),                       # trademark
-                  (r'''\b ?(\([rR]\))''', r'''&#174;'''),                           # registered
-                  (r'''\b ?(\([cC]\))''', r'''&#169;'''),                           # copyright
-                  (r'''([^\s])\[(\d+)\]''',                                         #
-                       r'''\1<sup class="footnote"><a href="#fn\2">\2</a></sup>'''),# footnote
-                  ]
-
         # Apply macros.
-        text = re.sub(r'''{([^}]+)}''', self.macros, text)
+        if '{' in text and 'macros' in self.features:
+            # A '{' after the last '}' would look for one up to the end
+            # of the text, so they are left out.
+            end = text.rfind('}') + 1
+            text = _macro.sub(self.macros, text[:end]) + text[end:]
 
         # LaTeX style quotes.
         text = text.replace('\x60\x60', '&#8220;')
         text = text.replace('\xb4\xb4', '&#8221;')
 
-        # Linkify URL and emails.
-        url = r'''(?=[a-zA-Z0-9./#])                          # Must start correctly
-                  ((?:                                        # Match the leading part (proto://hostname, or just hostname)
-                      (?:ftp|https?|telnet|nntp)              #     protocol
-                      ://                                     #     ://
-                      (?:                                     #     Optional 'username:password@'
-                          \w+                                 #         username
-                          (?::\w+)?                           #         optional :password
-                          @                                   #         @
-                      )?                                      # 
-                      [-\w]+(?:\.\w[-\w]*)+                   #     hostname (sub.example.com)
-                  )                                           #
-                  (?::\d+)?                                   # Optional port number
-                  (?:                                         # Rest of the URL, optional
-                      /?                                      #     Start with '/'
-                      [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]*       #     Can't start with these
-                      (?:                                     #
-                          [.!,?;:]+                           #     One or more of these
-                          [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]+   #     Can't finish with these
-                          #'"                                 #     # or ' or "
-                      )*                                      #
-                  )?)                                         #
-               '''
+        # If there is no html, do a simple search and replace.
+        if '<' not in text:
+            return self._glyphs_and_links(text)
 
-        email = r'''(?:mailto:)?            # Optional mailto:
-                    ([-\+\w]+               # username
-                    \@                      # at
-                    [-\w]+(?:\.\w[-\w]*)+)  # hostname
-                 '''
+        lines = []
+        # Else split the text into an array at <>.
+        for line in _split_tags(text):
+            if not (line.startswith('<') and _html_tag.match(line)):
+                line = self._glyphs_and_links(line)
 
-        # If there is no html, do a simple search and replace.
-        if not re.search(r'''<.*>''', text):
-            for glyph_search, glyph_replace in glyphs:
-                text = preg_replace(glyph_search, glyph_replace, text)
+            lines.append(line)
 
-            # Linkify.
-            text = re.sub(re.compile(url, re.VERBOSE), r'''<a href="\1">\1</a>''', text)
-            text = re.sub(re.compile(email, re.VERBOSE), r'''<a href="mailto:\1">\1</a>''', text)
+        return ''.join(lines)
 
-        else:
-            lines = []
-            # Else split the text into an array at <>.
-            for line in re.split('(<.*?>)', text):
-                if not re.match('<.*?>', line):
-                    for glyph_search, glyph_replace in glyphs:
-                        line = preg_replace(glyph_search, glyph_replace, line)
 
-                    # Linkify.
-                    line = re.sub(re.compile(url, re.VERBOSE), r'''<a href="\1">\1</a>''', line)
-                    line = re.sub(re.compile(email, re.VERBOSE), r'''<a href="mailto:\1">\1</a>''', line)
+    def _glyphs_and_links(self, text):
+        """Replace glyphs and linkify a piece of text outside tags."""
+        # The footnote glyph needs a non-whitespace character before it,
+        # as seen after the other glyphs were replaced: an em dash eats
+        # the whitespace around it, and a footnote eats the character
+        # that would allow the next one.
+        state = {'group': None, 'end': -1}
+
+        def _replace(m):
+            group = m.lastindex
+            if group == _GLYPH_NUMBERS:
+                rc = m.group()
+                if rc.endswith('-'):
+                    # The character after the dash stays outside the run.
+                    for p, replacement in _number_glyphs:
+                        rc = p.sub(replacement, rc)
+                else:
+                    for p, replacement in _number_glyphs[::2]:
+                        rc = p.sub(replacement, rc)
+            elif group == _GLYPH_FOOTNOTE:
+                start = m.start()
+                if state['end'] == start and state['group'] == _GLYPH_FOOTNOTE:
+                    ok = False
+                elif state['end'] == start and state['group'] == _GLYPH_EM_DASH:
+                    ok = True
+                else:
+                    ok = start > 0 and not _whitespace.match(text, start-1)
+                if not ok:
+                    return m.group()
+                n = m.group()[1:-1]
+                rc = '<sup class="footnote"><a href="#fn%s">%s</a></sup>' % (n, n)
+            else:
+                rc = _glyph_replacements[group]
+            state['group'] = group
+            state['end'] = m.end()
+            return rc
 
-                lines.append(line)
+        text = _glyph_pattern.sub(_replace, text)
 
-            text = ''.join(lines)
+        # Linkify.
+        if '://' in text:
+            text = _url.sub(r'''<a href="\1">\1</a>''', text)
+        if '@' in text:
+            text = _email.sub(r'''<a href="mailto:\1">\1</a>''', text)
 
         return text
 
@@ -2511,54 +4379,26 @@ class Textiler:
         (class) or (#id) or (class#id):For CSS(Cascading Style Sheets) class and id attributes. 
         """
         # itex2mml.
-        text = re.sub('\$(.*?)\$', lambda m: self.itex(m.group()), text)
+        if '$' in text and 'itex' in self.features:
+            text = _itex_inline.sub(lambda m: self.itex(m.group()), text)
 
         # Add span tags to upper-case words which don't have a description.
         #text = preg_replace(r'''(^|\s)([A-Z]{3,})\b(?!\()''', r'''\1<span class="caps">\2</span>''', text)
-        
-        # Quick tags.
-        qtags = [('**', 'b',      {'qf': '(?<!\*)\*\*(?!\*)', 'cls': '\*'}),
-                 ('__', 'i',      {'qf': '(?<!_)__(?!_)', 'cls': '_'}),
-                 ('??', 'cite',   {'qf': '\?\?(?!\?)', 'cls': '\?'}),
-                 ('-',  'del',    {'qf': '(?<!\-)\-(?!\-)', 'cls': '-'}),
-                 ('+',  'ins',    {'qf': '(?<!\+)\+(?!\+)', 'cls': '\+'}),
-                 ('*',  'strong', {'qf': '(?<!\*)\*(?!\*)', 'cls': '\*'}),
-                 ('_',  'em',     {'qf': '(?<!_)_(?!_)', 'cls': '_'}),
-                 ('++', 'big',    {'qf': '(?<!\+)\+\+(?!\+)', 'cls': '\+\+'}),
-                 ('--', 'small',  {'qf': '(?<!\-)\-\-(?!\-)', 'cls': '\-\-'}),
-                 ('~',  'sub',    {'qf': '(?<!\~)\~(?!(\\\/~))', 'cls': '\~'}),
-                 ('@',  'code',   {'qf': '(?<!@)@(?!@)', 'cls': '@'}),
-                 ('%',  'span',   {'qf': '(?<!%)%(?!%)', 'cls': '%'}),
-                ]
+
+        # Count all the delimiters in a single scan. A quick tag needs
+        # an opening and a closing delimiter, so we can skip the passes
+        # whose delimiter doesn't appear at least twice.
+        counts = {}
+        for c in _qtag_delimiters.findall(text):
+            counts[c] = counts.get(c, 0) + 1
 
         # Superscript.
-        text = re.sub(r'''(?<!\^)\^(?!\^)(.+?)(?<!\^)\^(?!\^)''', r'''<sup>\1</sup>''', text)
-
-        # This is from the perl version of Textile.
-        for qtag, htmltag, redict in qtags:
-            self.res.update(redict)
-            p = re.compile(r'''(?:                          #
-                                   ^                        # Start of string
-                                   |                        #
-                                   (?<=[\s>'"])             # Whitespace, end of tag, quotes
-                                   |                        #
-                                   (?P<pre>[{[])            # Surrounded by [ or {
-                                   |                        #
-                                   (?<=%(punct)s)           # Punctuation
-                               )                            #
-                               %(qf)s                       # opening tag
-                               %(qattr)s                    # attributes
-                               (?P<text>[^%(cls)s\s].*?)    # text
-                               (?<=\S)                      # non-whitespace
-                               %(qf)s                       # 
-                               (?:                          #
-                                   $                        # End of string
-                                   |                        #
-                                   (?P<post>[\]}])          # Surrounded by ] or }
-                                   |                        # 
-                                   (?=%(punct)s{1,2}|\s)    # punctuation
-                                )                           #
-                             ''' % self.res, re.VERBOSE)
+        if counts.get('^', 0) >= 2:
+            text = _superscript.sub(r'''<sup>\1</sup>''', text)
+
+        for qtag, htmltag, p, close in _qtag_patterns:
+            if counts.get(qtag[0], 0) < 2 * len(qtag):
+                continue
 
             def _replace(m):
                 c = m.groupdict('')
@@ -2574,7 +4414,7 @@ class Textiler:
          
                 return open_tag + c['text'] + close_tag
 
-            text = p.sub(_replace, text)
+            text = _qtag_sub(qtag, p, close, _replace, text)
 
         return text
 
@@ -2634,28 +4474,7 @@ class Textiler:
         Images receive the class "top" when using top alignment, "bottom" 
         for bottom alignment and "middle" for middle alignment.
         """
-        # Compile the beast.
-        p = re.compile(r'''\!               # Opening !
-                           %(iattr)s        # Image attributes
-                           (?P<src>%(url)s) # Image src
-                           \s?              # Optional whitesapce
-                           (                #
-                               \(           #
-                               (?P<alt>.*?) # Optional (alt) attribute
-                               \)           #
-                           )?               #
-                           \s?              # Optional whitespace
-                           %(resize)s       # Resize parameters
-                           \!               # Closing !
-                           (                # Optional link
-                               :            #    starts with ':'
-                               (?P<link>    #    
-                               %(url)s      #    link HREF
-                               )            #
-                           )?               #
-                        ''' % self.res, re.VERBOSE)
-
-        for m in p.finditer(text):
+        def _replace(m):
             c = m.groupdict('')
 
             # Build the parameters for the <img /> tag.
@@ -2669,9 +4488,10 @@ class Textiler:
             attributes['height'] = m.groups()[6] or m.groups()[8] or m.groups()[9]
 
             # Create the image tag.
-            tag = self.image(attributes)
+            return self.image(attributes)
 
-            text = text.replace(m.group(), tag)
+        if '!' in text:
+            text = _image_pattern.sub(_replace, text)
         
         return text
 
@@ -2752,61 +4572,40 @@ class Textiler:
         <a href="http://www.google.com/search?q=PyBlosxom">PyBlosxom</a>
         <a href="http://www.google.com/search?q=python+blosxom+textile">Using Textile and Blosxom with Python</a>
         """
-        linkres = [r'''\[                           # [
-                       (?P<quote>"|')               # Opening quotes
-                       %(lattr)s                    # Link attributes
-                       (?P<text>[^"]+?)             # Link text
-                       \s?                          # Optional whitespace
-                       (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
-                       (?P=quote)                   # Closing quotes
-                       :                            # :
-                       (?P<href>[^\]]+)             # HREF
-                       \]                           # ]
-                    ''' % self.res,
-                   r'''(?P<quote>"|')               # Opening quotes
-                       %(lattr)s                    # Link attributes
-                       (?P<text>[^"]+?)             # Link text
-                       \s?                          # Optional whitespace
-                       (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
-                       (?P=quote)                   # Closing quotes
-                       :                            # :
-                       (?P<href>%(url)s)            # HREF
-                    ''' % self.res]
-
-        for linkre in linkres:
-            p = re.compile(linkre, re.VERBOSE)
-            for m in p.finditer(text):
-                c = m.groupdict('')
+        def _replace(m):
+            c = m.groupdict('')
 
-                attributes = self.parse_params(c['parameters'])
-                attributes['title'] = c['title'].replace('"', '&quot;')
+            attributes = self.parse_params(c['parameters'])
+            attributes['title'] = c['title'].replace('"', '&quot;')
 
-                # Search lookup list.
-                link = self._links.get(c['href'], None) or c['href']
+            # Search lookup list.
+            link = self._links.get(c['href'], None) or c['href']
 
-                # Hyperlinks for Amazon, IMDB and Google searches.
-                parts = link.split(':', 1)
-                proto = parts[0]
-                if len(parts) == 2:
-                    query = parts[1]
-                else:
-                    query = c['text']
+            # Hyperlinks for Amazon, IMDB and Google searches.
+            parts = link.split(':', 1)
+            proto = parts[0]
+            if len(parts) == 2:
+                query = parts[1]
+            else:
+                query = c['text']
 
-                query = query.replace(' ', '+')
+            query = query.replace(' ', '+')
 
-                # Look for smart search.
-                if self.searches.has_key(proto):
-                    link = self.searches[proto] % query
-                
-                # Fix URL.
-                attributes['href'] = preg_replace('&(?!(#|amp))', '&amp;', link)
+            # Look for smart search.
+            if self.searches.has_key(proto):
+                link = self.searches[proto] % query
+            
+            # Fix URL.
+            attributes['href'] = preg_replace('&(?!(#|amp))', '&amp;', link)
 
-                open_tag = self.build_open_tag('a', attributes)
-                close_tag = '</a>'
+            open_tag = self.build_open_tag('a', attributes)
+            close_tag = '</a>'
 
-                repl = open_tag + c['text'] + close_tag
+            return open_tag + c['text'] + close_tag
 
-                text = text.replace(m.group(), repl)
+        if ':' in text:
+            for p in _link_patterns:
+                text = p.sub(_replace, text)
 
         return text
 
@@ -2816,12 +4615,26 @@ class Textiler:
 
         This function basically defines the order on which the 
         formatting is applied.
+
+        A stage is skipped when the text has none of the characters
+        it looks for (see _format_stages), which depend on the
+        features. The characters are only gathered again when a
+        stage changes the text.
         """
-        text = self.qtags(text)
-        text = self.images(text)
-        text = self.links(text)
-        text = self.acronym(text)
-        text = self.glyphs(text)
+        stats = STATS
+        chars = set(text)
+        for name, needed in self._stages:
+            if chars.isdisjoint(needed):
+                if stats:
+                    _stage_counts[name][1] += 1
+                continue
+
+            if stats:
+                _stage_counts[name][0] += 1
+            formatted = getattr(self, name)(text)
+            if formatted != text:
+                text = formatted
+                chars = set(text)
 
         return text
 
@@ -2837,14 +4650,14 @@ class Textiler:
 
         Inline formatting is applied within a block of text.
         """
-        if not re.search(r'''==(.*?)==''', text):
+        if '==' not in text or not _notextile.search(text):
             text = self.format(text)
 
         else:
             lines = []
             # Else split the text into an array at <>.
-            for line in re.split('(==.*?==)', text):
-                if not re.match('==.*?==', line):
+            for line in _notextile_split.split(text):
+                if not _notextile_match.match(line):
                     line = self.format(line)
                 else:
                     line = line[2:-2]
@@ -2864,9 +4677,100 @@ def textile(text, **args):
     This function should be called like this:
     
         textile(text, head_offset=0, validate=0, sanitize=0,
-                encoding='latin-1', output='ASCII')
+                encoding='latin-1', output='ASCII', cache=None, jobs=1,
+                features='full', profile=None)
+
+    <text> can also be a file object or an mmap, which is read in
+    pieces, so a big file doesn't have to be read in a string first.
+    If a StageProfile is given as <profile>, the time of each stage
+    is recorded there.
+    """
+    features = args.pop('features', FEATURES)
+    profile = args.pop('profile', None)
+    return Textiler(text, features, profile).process(**args)
+
+
+def parse(text, features=FEATURES, cache_dir=None, profile=None):
+    """Split a text in blocks for render().
+
+    The document from parse() can be rendered many times, with
+    different options, without splitting the text again:
+
+        document = parse(text)
+        html = render(document, head_offset=1)
+        xhtml = render(document, output='utf-8', sanitize=1)
+
+    Only the preprocessing, the links and the split are saved: the
+    attributes and inline formatting of the blocks are done by
+    render() every time, and they are most of the work.
+
+    If <cache_dir> is given, documents are also kept there, in files
+    named after a hash of the text, and a text parsed before is
+    loaded from its file instead. The parsing is timed in
+    <profile>, if given.
+    """
+    if cache_dir is None:
+        return Textiler(text, features, profile).parse()
+
+    if hasattr(text, 'read'):
+        text = text.read()
+    features = list(_get_features(features))
+    features.sort()
+
+    key = hashlib.md5(repr((__version__, features)))
+    key.update(text)
+    path = os.path.join(cache_dir, key.hexdigest() + '.blocks')
+    try:
+        f = open(path, 'rb')
+        try:
+            return marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    document = Textiler(text, features, profile).parse()
+
+    # Write it under another name first, so no one reads half of it.
+    temp = '%s.%d' % (path, os.getpid())
+    try:
+        f = open(temp, 'wb')
+        try:
+            marshal.dump(document, f)
+        finally:
+            f.close()
+        os.rename(temp, path)
+    except (IOError, OSError):
+        pass
+
+    return document
+
+
+def render(document, **args):
+    """Render a document from parse() to XHTML.
+
+    Takes the same arguments as textile(), except for features,
+    which are those the document was parsed with.
+    """
+    profile = args.pop('profile', None)
+    return Textiler(features=document[1], profile=profile).render(document, **args)
+
+
+def textile_iter(fileobj, **args):
+    """Streaming Textile.
+
+    Like textile(), but reads the text from a file object and
+    returns an iterator over the HTML, which is generated block by
+    block. It accepts the same arguments, except for validate and
+    jobs. A StageProfile given as <profile> doesn't time the passes
+    over the whole text, see StageProfile:
+
+        for html in textile_iter(open('chapter.textile')):
+            out.write(html)
     """
-    return Textiler(text).process(**args)
+    features = args.pop('features', FEATURES)
+    profile = args.pop('profile', None)
+    return Textiler(features=features, profile=profile).process_stream(fileobj, **args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+
+# Renders a corpus of textile documents and compares the output with the
+# HTML recorded in textile_corpus/. Every optimization of textile.py must
+# keep the output byte-identical, so run this after touching the engine:
+#
+#   python textile_check.py            # check
+#   python textile_check.py --update   # re-record expected output
+#
+# It can also compare with another version of textile.py, on the corpus and
+# on <n> random documents made of markup-heavy snippets:
+#
+#   git show HEAD~1:./textile.py > /tmp/textile_old.py
+#   python textile_check.py --baseline=/tmp/textile_old.py --fuzz=10000
+
+import sys
+import os.path
+import imp
+import random
+import shutil
+import tempfile
+import threading
+import pstats
+from StringIO import StringIO
+import textile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+CORPUSDIR = os.path.join(SCRIPT_DIR, "textile_corpus")
+TXTSRCDIR = os.path.join(SCRIPT_DIR, "..", "txtsrc")
+
+def read(path):
+    fo = open(path, "rb")
+    d = fo.read()
+    fo.close()
+    return d
+
+def write(path, data):
+    fo = open(path, "wb")
+    fo.write(data)
+    fo.close()
+
+# Returns a list of (name, text, args) tuples. <name> is also the name of the
+# file (without .html) with the expected output.
+def cases():
+    res = []
+    for f in sorted(os.listdir(CORPUSDIR)):
+        if f.endswith(".textile"):
+            name = f[:-len(".textile")]
+            res.append((name, read(os.path.join(CORPUSDIR, f)), {}))
+    for f in sorted(os.listdir(TXTSRCDIR)):
+        if f.endswith(".textile"):
+            name = "txtsrc-" + f[:-len(".textile")]
+            res.append((name, read(os.path.join(TXTSRCDIR, f)), {}))
+    res.append(("about", "tell me about textile.", {"head_offset" : 1}))
+    blocks = read(os.path.join(CORPUSDIR, "blocks.textile"))
+    res.append(("blocks-head-offset", blocks, {"head_offset" : 2}))
+    glyphs = read(os.path.join(CORPUSDIR, "glyphs.textile"))
+    res.append(("glyphs-utf8", glyphs, {"output" : "utf-8"}))
+    sanitize = read(os.path.join(CORPUSDIR, "sanitize.textile"))
+    res.append(("sanitize-on", sanitize, {"sanitize" : 1}))
+    mixed = read(os.path.join(CORPUSDIR, "mixed.textile"))
+    res.append(("mixed-sanitize", mixed, {"sanitize" : 1}))
+    return res
+
+def expected_path(name):
+    return os.path.join(CORPUSDIR, name + ".html")
+
+# Pieces of markup that random documents are made of.
+FUZZ_SNIPPETS = ["word", "Word", "x", "2", "10", " ", " ", " ", "\n", "\n\n",
+    "*", "**", "_", "__", "-", "--", "---", "+", "++", "~", "@", "%", "^", "??",
+    "$", "!", "(", ")", "[", "]", "{", "}", "|", "#", "=", "==", "<", ">", ".",
+    "...", ",", ":", ";", "'", '"', "&", "`", "\xb4", "\xe9", "(c)", "(TM)",
+    "[1]", "1x2", "1-2", "1-", " - ", " x ", "(r)", "\t", "ABC", "NASA(N A S A)",
+    "(class)", "(#id)", "[en]",
+    "{color:red}", "<b>", "</b>", "<br>", "{e'}", "{umbrella}", '"link":http://a.com/b',
+    "'q':ex", "[ex]http://ex.com/", "http://x.com/a?b=1", "a@b.com", "!i.png!",
+    "!<i.png(alt)!:http://l.com", "h1. ", "p. ", "bq. ", "pre.. ", "bc. ", "fn1. ",
+    "# ", "## ", "* ", "*# ", "|a|b|", "|_. h|", "table. ", "dl. ", "clear. "]
+
+def fuzz_document(rnd):
+    n = rnd.randint(1, 40)
+    return "".join([rnd.choice(FUZZ_SNIPPETS) for i in range(n)])
+
+# Compares the output of <textile> and <baseline> on the corpus and on <n>
+# random documents. Returns the number of differences.
+def compare(baseline, n):
+    failed = 0
+    for (name, text, args) in cases():
+        if textile.textile(text, **args) != baseline.textile(text, **args):
+            print("%s: output differs from baseline" % name)
+            failed += 1
+    rnd = random.Random(0)
+    for i in range(n):
+        text = fuzz_document(rnd)
+        try:
+            expected = baseline.textile(text)
+        except Exception:
+            # Some garbage crashes the baseline too, ignore it.
+            continue
+        html = textile.textile(text)
+        if html != expected:
+            print("fuzz document differs from baseline:\n%r" % text)
+            failed += 1
+    return failed
+
+# Renders every case twice with a block cache: the second time all blocks
+# must come from the cache, with the same output as without it.
+def check_cache():
+    failed = 0
+    cache = textile.BlockCache(size=100000)
+    for (name, text, args) in cases():
+        expected = textile.textile(text, **args)
+        for i in range(2):
+            misses = cache.misses
+            html = textile.textile(text, cache=cache, **args)
+            if html != expected:
+                print("%s: output with cache differs" % name)
+                failed += 1
+        if cache.misses != misses:
+            print("%s: blocks missing from cache" % name)
+            failed += 1
+    cache.close()
+
+    # Options that change the output of the blocks must change their
+    # keys, so nothing rendered with the old ones is used.
+    text = 'A "book":amazon.\n\nbc. code'
+    cache = textile.BlockCache()
+    saved = (textile.amazon_associate_id, textile.htmlizer)
+    try:
+        textile.textile(text, cache=cache)
+        for option, value in [("amazon_associate_id", "x-21"), ("htmlizer", not textile.htmlizer)]:
+            setattr(textile, option, value)
+            misses = cache.misses
+            textile.textile(text, cache=cache)
+            if cache.misses != misses + 2:
+                print("cache: blocks not rendered again after changing %s" % option)
+                failed += 1
+    finally:
+        textile.amazon_associate_id, textile.htmlizer = saved
+        cache.close()
+
+    # A small cache must drop the block least recently used, also
+    # after being opened again.
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        cache = textile.BlockCache(path, size=3)
+        for key in "abc":
+            cache.put(key, key)
+        cache.get("a")
+        cache.put("d", "d")
+        cache.close()
+        cache = textile.BlockCache(path, size=3)
+        cache.put("e", "e")
+        kept = "".join([key for key in "abcde" if cache.get(key) is not None])
+        cache.close()
+        if kept != "ade":
+            print("cache: kept blocks %s instead of ade" % kept)
+            failed += 1
+    finally:
+        os.remove(path)
+    return failed
+
+# Renders every case with textile_iter, which must give the same output as
+# textile(). Reading a few bytes at a time puts block boundaries everywhere.
+def check_stream():
+    failed = 0
+    read_size = textile._READ_SIZE
+    for (name, text, args) in cases():
+        expected = textile.textile(text, **args)
+        for textile._READ_SIZE in [1, 7, read_size]:
+            html = "".join(textile.textile_iter(StringIO(text), **args))
+            if html != expected:
+                print("%s: output of textile_iter differs (read size %d)" % (name, textile._READ_SIZE))
+                failed += 1
+    textile._READ_SIZE = read_size
+    return failed
+
+# Renders every case in two processes, which must give the same output.
+def check_jobs():
+    failed = 0
+    for (name, text, args) in cases():
+        if textile.textile(text, jobs=2, **args) != textile.textile(text, **args):
+            print("%s: output with jobs=2 differs" % name)
+            failed += 1
+    return failed
+
+# Renders every case with the minimal profile, which must give the same
+# output with textile_iter, with jobs=2 and with a cache; and the full
+# profile must give the default output.
+def check_features():
+    failed = 0
+    cache = textile.BlockCache(size=100000)
+    for (name, text, args) in cases():
+        if textile.textile(text, features="full", **args) != textile.textile(text, **args):
+            print("%s: output with the full profile differs" % name)
+            failed += 1
+        expected = textile.textile(text, features="minimal", **args)
+        html = "".join(textile.textile_iter(StringIO(text), features="minimal", **args))
+        if html != expected:
+            print("%s: output of textile_iter with the minimal profile differs" % name)
+            failed += 1
+        if textile.textile(text, features="minimal", jobs=2, **args) != expected:
+            print("%s: output with the minimal profile and jobs=2 differs" % name)
+            failed += 1
+        textile.textile(text, cache=cache, **args)
+        if textile.textile(text, features="minimal", cache=cache, **args) != expected:
+            print("%s: output with the minimal profile and a cache differs" % name)
+            failed += 1
+    cache.close()
+    return failed
+
+# Parses every case once, storing the document in a cache directory, and
+# renders it with other options, which must give the same output as
+# textile(). Parsing again must load the same document from the cache.
+def check_parse():
+    failed = 0
+    path = tempfile.mkdtemp()
+    try:
+        for (name, text, args) in cases():
+            for features in ["full", "minimal"]:
+                document = textile.parse(text, features=features, cache_dir=path)
+                if textile.parse(text, features=features, cache_dir=path) != document:
+                    print("%s: document loaded from the cache differs" % name)
+                    failed += 1
+                for options in [{}, {"head_offset": 2}, {"sanitize": 1}, {"output": "utf-8"}]:
+                    options = dict(args, **options)
+                    # The sanitizer fails on non-ASCII output.
+                    if options.get("sanitize") and options.get("output", "ASCII") != "ASCII":
+                        continue
+                    expected = textile.textile(text, features=features, **options)
+                    if textile.render(document, **options) != expected:
+                        print("%s: rendered document differs (%s, %r)" % (name, features, options))
+                        failed += 1
+    finally:
+        shutil.rmtree(path)
+    return failed
+
+# Renders every case with a StageProfile, which must not change the
+# output, and must count the blocks and the encoding of each run. Its
+# profile must load in pstats.
+def check_profile():
+    failed = 0
+    profile = textile.StageProfile()
+    for (name, text, args) in cases():
+        if textile.textile(text, profile=profile, **args) != textile.textile(text, **args):
+            print("%s: output with a profile differs" % name)
+            failed += 1
+
+    # With STATS on, the patterns are timed too.
+    textile.STATS = 1
+    try:
+        for (name, text, args) in cases():
+            if textile.textile(text, **args) != read(expected_path(name)):
+                print("%s: output with STATS on differs" % name)
+                failed += 1
+    finally:
+        textile.STATS = 0
+    if not textile.pattern_stats()[0][0]:
+        print("profile: patterns not timed with STATS on")
+        failed += 1
+
+    # A stage within itself, like a paragraph in a blockquote in a
+    # paragraph, makes calls that are not primitive.
+    def blockquote(depth):
+        return paragraph(depth - 1)
+    def paragraph(depth):
+        if depth:
+            return blockquote(depth)
+    blockquote = profile._timed("blockquote", blockquote)
+    paragraph = profile._timed("paragraph", paragraph)
+    paragraph(3)
+
+    stages = profile.as_dict()
+    if stages["encode"]["calls"] != len(cases()) or stages["paragraph"]["calls"] == 0:
+        print("profile: missing stages")
+        failed += 1
+    path = tempfile.mkdtemp()
+    try:
+        profile.dump_stats(os.path.join(path, "stages.prof"))
+        stats = pstats.Stats(os.path.join(path, "stages.prof")).stats
+        if len(stats) != len(stages):
+            print("profile: pstats doesn't have all the stages")
+            failed += 1
+        for (filename, line, name), (cc, nc, tt, ct, callers) in stats.items():
+            for (filename, line, caller), counts in callers.items():
+                if counts[0] != stages[name]["callers"][caller]:
+                    print("profile: pstats has %d calls of %s by %s instead of %d" % (counts[0], name, caller, stages[name]["callers"][caller]))
+                    failed += 1
+    finally:
+        shutil.rmtree(path)
+    return failed
+
+# Renders math with itex2mml_stub.py standing in for itex2MML. All the
+# equations of a document must be converted in a single run, with the
+# same output as when they are converted one by one.
+ITEX_TEXT = r"""h1. Euler's $e^{i\pi}+1=0$
+
+Euler's formula, $e^{i\pi}+1=0$, has $e$, $i$ and $\pi$ in it; $x'$ is 'quoted'.
+
+\[x = \frac{1}{2}
++ y\]
+
+* a list with $x^2$
+* and $y_1$"""
+
+class OneByOneTextiler(textile.Textiler):
+    def _prefetch_itex(self, text):
+        pass
+
+def check_itex():
+    failed = 0
+    fd, log = tempfile.mkstemp()
+    os.close(fd)
+    os.environ["ITEX_STUB_LOG"] = log
+    itex2mml = textile.itex2mml
+    results_size = textile._ITEX_RESULTS_SIZE
+    textile.itex2mml = '"%s" "%s"' % (sys.executable, os.path.join(SCRIPT_DIR, "itex2mml_stub.py"))
+    try:
+        textile._itex_results.clear()
+        html = textile.textile(ITEX_TEXT)
+        runs = len(read(log).splitlines())
+        if runs != 1:
+            print("itex: %d itex2mml runs instead of 1" % runs)
+            failed += 1
+        if html.count("<math") != 9:
+            print("itex: equations missing in the output")
+            failed += 1
+        textile._itex_results.clear()
+        if "".join(textile.textile_iter(StringIO(ITEX_TEXT))) != html:
+            print("itex: output of textile_iter differs")
+            failed += 1
+        textile._itex_results.clear()
+        if OneByOneTextiler(ITEX_TEXT).process() != html:
+            print("itex: output differs when converting equations one by one")
+            failed += 1
+        # With a cache, only the equations of the blocks it misses are
+        # converted.
+        cache = textile.BlockCache()
+        for i in range(2):
+            textile._itex_results.clear()
+            runs = len(read(log).splitlines())
+            if textile.textile(ITEX_TEXT, cache=cache) != html:
+                print("itex: output with a cache differs")
+                failed += 1
+            if "".join(textile.textile_iter(StringIO(ITEX_TEXT), cache=cache)) != html:
+                print("itex: output of textile_iter with a cache differs")
+                failed += 1
+            runs = len(read(log).splitlines()) - runs
+            if runs != 1 - i:
+                print("itex: %d itex2mml runs instead of %d with a cache" % (runs, 1 - i))
+                failed += 1
+        cache.close()
+        textile._itex_results.clear()
+        textile._ITEX_RESULTS_SIZE = 4
+        if textile.textile(ITEX_TEXT) != html:
+            print("itex: output differs when the results don't fit")
+            failed += 1
+        if len(textile._itex_results) > 4:
+            print("itex: %d results kept instead of 4" % len(textile._itex_results))
+            failed += 1
+    finally:
+        textile._ITEX_RESULTS_SIZE = results_size
+        textile.itex2mml = itex2mml
+        textile._itex_results.clear()
+        del os.environ["ITEX_STUB_LOG"]
+        os.remove(log)
+    return failed
+
+# Renders Python code blocks twice with a color cache: the second time no
+# code must be colorized. htmlizer may not be installed, so a colorizer
+# that counts its calls stands in for it.
+COLOR_TEXT = "\n\n".join(["bc[python]. def f%d(x):\n    return x + %d" % (i, i) for i in range(10)])
+
+def check_color():
+    failed = 0
+    calls = []
+    def color(code):
+        calls.append(code)
+        return "<span>%s</span>" % code.replace("<", "&lt;")
+    saved = (textile.htmlizer, getattr(textile, "_color", None), textile.COLOR_CACHE)
+    path = tempfile.mkdtemp()
+    textile.htmlizer = True
+    textile._color = color
+    textile.COLOR_CACHE = path
+    try:
+        expected = textile.textile(COLOR_TEXT)
+        if len(calls) != 10 or textile.color_cache().misses != 10:
+            print("color cache: %d blocks colorized instead of 10" % len(calls))
+            failed += 1
+        del calls[:]
+        for jobs in [1, 2]:
+            if textile.textile(COLOR_TEXT, jobs=jobs) != expected:
+                print("color cache: output differs with the cache (jobs=%d)" % jobs)
+                failed += 1
+        if calls or textile.color_cache().hit_rate() != 0.5:
+            print("color cache: code colorized again")
+            failed += 1
+        blocks = textile.BlockCache(path)
+        if textile.color_cache().path == blocks.path:
+            print("color cache: same database as the block cache")
+            failed += 1
+        blocks.close()
+
+        # Another path opens another cache, closing the old one.
+        old = textile.color_cache()
+        textile.COLOR_CACHE = os.path.join(path, "other.db")
+        if textile.color_cache() is old or not old._closed:
+            print("color cache: old cache not closed when the path changed")
+            failed += 1
+    finally:
+        textile.color_cache().close()
+        textile.htmlizer, textile._color, textile.COLOR_CACHE = saved
+        shutil.rmtree(path)
+    return failed
+
+# Renders all cases from many threads at once, in a different order in
+# each thread, half of them sharing a block cache. Every output must be
+# the same as when rendering alone.
+THREADS = 8
+ROUNDS = 3
+
+def check_threads():
+    todo = [(name, text, args, textile.textile(text, **args)) for (name, text, args) in cases()]
+    cache = textile.BlockCache(size=100)
+    errors = []
+    def run(n):
+        rnd = random.Random(n)
+        for i in range(ROUNDS):
+            mine = todo[:]
+            rnd.shuffle(mine)
+            for (name, text, args, expected) in mine:
+                try:
+                    if n % 2:
+                        html = textile.textile(text, cache=cache, **args)
+                    else:
+                        html = textile.textile(text, **args)
+                except Exception, e:
+                    html = repr(e)
+                if html != expected:
+                    errors.append("%s: output differs when rendering in %d threads" % (name, THREADS))
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cache.close()
+    for error in errors:
+        print(error)
+    return len(errors)
+
+def main():
+    update = "--update" in sys.argv[1:]
+    baseline = None
+    nfuzz = 0
+    for arg in sys.argv[1:]:
+        if arg.startswith("--baseline="):
+            baseline = imp.load_source("textile_baseline", arg[len("--baseline="):])
+        elif arg.startswith("--fuzz="):
+            nfuzz = int(arg[len("--fuzz="):])
+    if baseline is not None:
+        failed = compare(baseline, nfuzz)
+        if failed:
+            print("%d difference(s)" % failed)
+            return 1
+        print("no differences with baseline")
+        return 0
+    failed = 0
+    for (name, text, args) in cases():
+        html = textile.textile(text, **args)
+        path = expected_path(name)
+        if update:
+            write(path, html)
+            continue
+        if not os.path.exists(path):
+            print("%s: no expected output, run with --update" % name)
+            failed += 1
+            continue
+        expected = read(path)
+        if html != expected:
+            print("%s: output differs from %s" % (name, os.path.basename(path)))
+            failed += 1
+    if update:
+        return 0
+    failed += check_cache()
+    failed += check_stream()
+    failed += check_jobs()
+    failed += check_features()
+    failed += check_parse()
+    failed += check_profile()
+    failed += check_itex()
+    failed += check_color()
+    failed += check_threads()
+    if failed:
+        print("%d case(s) failed" % failed)
+        return 1
+    print("all %d cases ok" % len(cases()))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())